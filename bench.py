@@ -0,0 +1,292 @@
+"""
+   end to end benchmark
+   Generates synthetic Snap2SNOMED exports, RF2 snapshots and rrs.txt files of several sizes, runs the
+   fetcher and lighter stages against the local stand-in server and times each stage separately,
+   along with the time to import each entry point.
+   Results are compared to a stored baseline and the run fails if any stage regressed.
+
+   python bench.py --sizes 1000,10000 --save-baseline
+   python bench.py --sizes 1000,10000
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import fetcher
+import lighter
+import stubserver
+from helpers import make_sctid, dumps_json
+from journal import ArtefactManifest
+
+logger = logging.getLogger(__name__)
+
+focus_codes = ["168537006", "77477000", "113091000"]
+methods = {"168537006": "278292003", "77477000": "312251004", "113091000": "312250003"}
+left_sites = ["787058006", "999002006", "82169009"]
+right_sites = ["999001004", "999003001", "6757004"]
+plain_sites = ["818981001", "69536005", "50408007"]
+# synthetic concept item identifiers start here, clear of the fixture
+first_item = 2000000
+
+
+## write_synthetic_rf2
+## Copy the RF2 fixture and add n synthetic imaging procedures below the fixture focus procedures
+##   return the list of synthetic procedure codes
+def write_synthetic_rf2(dirname, n, seed=1):
+    rng = random.Random(seed)
+    for filename in glob.glob(os.path.join(stubserver.default_rf2, '*.txt')):
+        shutil.copy(filename, dirname)
+    concept_file = glob.glob(os.path.join(dirname, 'sct2_Concept_Snapshot*'))[0]
+    relationship_file = glob.glob(os.path.join(dirname, 'sct2_Relationship_Snapshot*'))[0]
+    description_file = glob.glob(os.path.join(dirname, 'sct2_Description_Snapshot*'))[0]
+    codes = []
+    with open(concept_file, 'a') as fc, open(relationship_file, 'a') as fr, open(description_file, 'a') as fd:
+        for i in range(n):
+            code = make_sctid(first_item + i)
+            codes.append(code)
+            parent = rng.choice(focus_codes)
+            fc.write(f"{code}\t20240101\t1\t900000000000207008\t900000000000073002\n")
+            rels = [(parent, 0, "116680003"), (methods[parent], 1, "260686004")]
+            shape = rng.random()
+            if shape < 0.1:
+                rels += [(left_sites[i % 3], 1, "405813007"), (methods[parent], 2, "260686004"),
+                         (right_sites[i % 3], 2, "405813007")]
+            elif shape < 0.5:
+                rels.append((rng.choice(left_sites + right_sites), 1, "405813007"))
+            else:
+                rels.append((rng.choice(plain_sites), 1, "405813007"))
+            contrast = rng.random()
+            if contrast < 0.2:
+                rels.append(("385420005", 1, "424361007"))
+            for j, (dst, group, type_id) in enumerate(rels):
+                rel_id = make_sctid((first_item + i) * 10 + j, "02")
+                fr.write(f"{rel_id}\t20240101\t1\t900000000000207008\t{code}\t{dst}\t{group}\t{type_id}"
+                         f"\t900000000000011006\t900000000000451002\n")
+            suffix = " without contrast" if 0.2 <= contrast < 0.3 else ""
+            desc_id = make_sctid(first_item + i, "01")
+            fd.write(f"{desc_id}\t20240101\t1\t900000000000207008\t{code}\ten\t900000000000003001"
+                     f"\tSynthetic imaging procedure {i}{suffix} (procedure)\t900000000000448009\n")
+    return codes
+
+
+## write_synthetic_s2s
+## Write a Snap2SNOMED export of n rows over codes, with some duplicate and non equivalent rows
+def write_synthetic_s2s(filename, codes, n, seed=1):
+    rng = random.Random(seed)
+    with open(filename, 'w') as fh:
+        fh.write("Source code\tSource display\tTarget code\tTarget display\tRelationship type code\tNo map flag\tStatus\n")
+        for i in range(n):
+            code = codes[i % len(codes)] if rng.random() > 0.05 else rng.choice(codes)
+            rel = "TARGET_EQUIVALENT" if rng.random() > 0.05 else "TARGET_NARROWER"
+            fh.write(f"RAD{i:06d}\tRadiology service {i}\t{code}\tProcedure\t{rel}\tfalse\tACCEPTED\n")
+
+
+## write_synthetic_rrs
+## Write an rrs.txt of n rows
+def write_synthetic_rrs(filename, n, seed=1):
+    rng = random.Random(seed)
+    sites = [make_sctid(first_item + 500000 + i) for i in range(max(n // 10, 1))]
+    with open(filename, 'w') as fh:
+        fh.write("Service\tProcedure\tSite\tLaterality\tContrast\n")
+        for i in range(n):
+            fh.write("\t".join([make_sctid(first_item + i), rng.choice(focus_codes), rng.choice(sites + [""]),
+                                rng.choice(["", "7771000", "24028007", "51440002"]),
+                                rng.choice(["", "373066001", "373067005"])]) + "\n")
+
+
+class StageTimer:
+    """
+    Wall and CPU time and Python memory high-water mark per stage
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        tracemalloc.start()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.stages[name] = {
+                "wall": round(time.perf_counter() - wall, 4),
+                "cpu": round(time.process_time() - cpu, 4),
+                "peak_mb": round(peak / (1024 * 1024), 2)
+            }
+            print(f'  {name:<12} {self.stages[name]["wall"]:>9.3f}s {self.stages[name]["peak_mb"]:>9.2f}MB')
+
+
+## bench_fetcher
+## Time the fetcher stages over a synthetic Snap2SNOMED export against the stand-in server
+def bench_fetcher(timer, s2sfile, batch_size):
+    with timer.stage("read"):
+        codes = list(fetcher.read_s2s(s2sfile))
+    with timer.stage("context"):
+        ctx = fetcher.TerminologyContext.build()
+    with timer.stage("properties"):
+        props = fetcher.get_concept_props_batch(codes, batch_size)
+        frames = [fetcher.get_snomed_props(code, props[code]) for code in codes]
+    with timer.stage("sites"):
+        rows = [fetcher.expand_body_site(df, ctx) for df in frames]
+    return len(codes), sum(1 for row in rows if row)
+
+
+## bench_lighter
+## Time the lighter stages over a synthetic rrs.txt, publishing to the stand-in server the way
+## lighter.run_main does, one file at a time or with transaction in one transaction Bundle
+def bench_lighter(timer, rrsfile, outdir, endpoint, transaction=False):
+    templates_path = 'templates'
+    vs_files = lighter.create_vs_filepath(outdir)
+    templates = lighter.get_template_files(templates_path)
+    manifest = ArtefactManifest(os.path.join(outdir, "artefacts.manifest.json"))
+    with timer.stage("load"):
+        table = lighter.load_rrs(rrsfile)
+    with timer.stage("valuesets"):
+        for col in range(0, 5):
+            lighter.build_valueset(col, templates[col], table, vs_files[col], None, manifest=manifest)
+    with timer.stage("conceptmap"):
+        lighter.build_concept_map(table, outdir, None, templates_path, manifest=manifest)
+    artefacts = vs_files + [os.path.join(outdir, "ConceptMap_RadiologyServices.json")]
+    resources = []
+    for filename in artefacts:
+        with open(filename) as f:
+            resources.append(json.load(f))
+    with timer.stage("serialise"):
+        for data in resources:
+            dumps_json(data)
+    with timer.stage("publish"):
+        smart = lighter.create_client(endpoint)
+        if transaction:
+            lighter.publish_transaction(smart, artefacts, outdir, manifest)
+        else:
+            for filename, data in zip(artefacts, resources):
+                lighter.publish_file(smart, data["resourceType"], data.get("id"), filename, manifest)
+
+
+## bench_imports
+## Time importing each entry point in a fresh interpreter, less the interpreter's own startup, best of repeat
+def bench_imports(modules=("main", "lighter", "fetcher"), repeat=3):
+    def run(code):
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+    startup = run("pass")
+    results = {}
+    for module in modules:
+        results[module] = {"wall": round(max(run(f"import {module}") - startup, 0), 4), "cpu": 0, "peak_mb": 0}
+        print(f'  import {module:<7} {results[module]["wall"]:>9.3f}s')
+    return results
+
+
+## compare
+## Compare results with a baseline
+##   return a list of regression messages, empty if nothing regressed
+def compare(results, baseline, tolerance, min_seconds=0.05):
+    regressions = []
+    for size, stages in results.items():
+        label = f'{size} rows' if size.isdigit() else size
+        for name, stats in stages.items():
+            base = baseline.get(size, {}).get(name)
+            if name == "summary" or not base:
+                continue
+            if stats["wall"] > max(base["wall"] * (1 + tolerance), min_seconds):
+                regressions.append(f'{label} {name}: {stats["wall"]}s vs baseline {base["wall"]}s')
+            if stats["peak_mb"] > max(base["peak_mb"] * (1 + tolerance), 1):
+                regressions.append(f'{label} {name}: {stats["peak_mb"]}MB vs baseline {base["peak_mb"]}MB')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", help="comma separated row counts", default="1000,10000,100000")
+    parser.add_argument("--latency", help="stand-in server delay per request in milliseconds", type=float, default=0)
+    parser.add_argument("--batch-size", help="codes per batch $lookup Bundle", type=int, default=100)
+    parser.add_argument("--transaction", help="publish the artefacts in one transaction Bundle", action="store_true")
+    parser.add_argument("--baseline", help="baseline results file", default="bench-baseline.json")
+    parser.add_argument("--save-baseline", help="write the results as the new baseline", action="store_true")
+    parser.add_argument("--tolerance", help="allowed slowdown or memory growth before failing, 0.25 is 25%%", type=float, default=0.25)
+    parser.add_argument("--output", help="results file", default="bench-results.json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    # lighter reads the templates and procedures.txt relative to the source folder, so run from there
+    args.baseline = os.path.abspath(args.baseline)
+    args.output = os.path.abspath(args.output)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    results = {}
+    print('imports')
+    results["imports"] = bench_imports()
+    saved_baseurl = fetcher.baseurl
+    for size in [int(s) for s in args.sizes.split(',')]:
+        print(f'{size} rows')
+        timer = StageTimer()
+        with tempfile.TemporaryDirectory() as workdir:
+            rf2dir = os.path.join(workdir, 'rf2')
+            os.makedirs(rf2dir)
+            codes = write_synthetic_rf2(rf2dir, max(size * 9 // 10, 1))
+            s2sfile = os.path.join(workdir, 's2s.tsv')
+            write_synthetic_s2s(s2sfile, codes, size)
+            rrsfile = os.path.join(workdir, 'rrs.txt')
+            write_synthetic_rrs(rrsfile, size)
+            server = stubserver.start_server(rf2=rf2dir, latency=args.latency / 1000)
+            try:
+                fetcher.set_terminology(server.base_url)
+                start = time.perf_counter()
+                unique, built = bench_fetcher(timer, s2sfile, args.batch_size)
+                bench_lighter(timer, rrsfile, workdir, server.base_url, args.transaction)
+                elapsed = time.perf_counter() - start
+                requests = server.store.requests
+            finally:
+                server.shutdown()
+                fetcher.baseurl = saved_baseurl
+        results[str(size)] = dict(timer.stages)
+        results[str(size)]["summary"] = {
+            "unique_codes": unique,
+            "rows_built": built,
+            "server_requests": requests,
+            "rows_per_second": round(size / elapsed, 1),
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        }
+        print(f'  {results[str(size)]["summary"]}')
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Saved baseline {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        # nothing to compare against is a failure, so a missing baseline can't pass a regression check
+        print(f'No baseline {args.baseline}, run with --save-baseline first')
+        return 2
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for msg in regressions:
+        print('REGRESSION: ' + msg)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""
+   persistent terminology response cache
+   SQLite backed store of terminology server responses keyed by request URL and SNOMED CT version
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# Hits whose accessed time is written in one transaction
+ACCESS_BATCH = 200
+# Puts between re-reading the cache size, which the processes of a sharded build share
+RESYNC_PUTS = 1000
+
+
+class TerminologyCache:
+    """
+    Cache of terminology server JSON responses.
+    Entries are keyed by the SNOMED CT version of the server and the request URL so that
+    a new edition on the server never returns stale expansions.  Entries older than ttl
+    seconds are ignored, and the least recently used entries are evicted once the
+    compressed bodies exceed max_bytes.  The size is kept as a running total, and the accessed
+    time of hits is written ACCESS_BATCH at a time, before an eviction and on close.
+    """
+
+    def __init__(self, filename, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES, version=""):
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.filename = filename
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._accessed = {}
+        self._puts = 0
+        self._lock = threading.Lock()
+        # the cache may be shared by the processes of a sharded build, WAL lets them read while one writes
+        self._conn = sqlite3.connect(filename, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " body BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+        self._conn.commit()
+        self.total_bytes = self._size()
+
+    def _size(self):
+        return self._conn.execute("SELECT COALESCE(SUM(size),0) FROM responses").fetchone()[0]
+
+    def _key(self, url):
+        return "{0}|{1}".format(self.version, url)
+
+    def get(self, url):
+        """
+        Return the cached JSON response for url, or None on a miss
+        """
+        key = self._key(url)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT body, created, size FROM responses WHERE key=?", (key,)).fetchone()
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key=?", (key,))
+                    self._conn.commit()
+                    self._accessed.pop(key, None)
+                    self.total_bytes -= row[2]
+                self.misses += 1
+                return None
+            self._accessed[key] = now
+            if len(self._accessed) >= ACCESS_BATCH:
+                self._flush_accessed()
+                self._conn.commit()
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, url, data):
+        """
+        Store the JSON response for url, evicting old entries if the cache is over size
+        """
+        body = zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+        now = time.time()
+        key = self._key(url)
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key=?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, body, size, created, accessed) VALUES (?,?,?,?,?)",
+                (key, body, len(body), now, now))
+            self._accessed.pop(key, None)
+            self._puts += 1
+            if self._puts % RESYNC_PUTS == 0:
+                self.total_bytes = self._size()
+            else:
+                self.total_bytes += len(body) - (old[0] if old else 0)
+            self._evict()
+            self._conn.commit()
+
+    ## _flush_accessed
+    ## Write the accessed times of the hits since the last flush, the caller commits
+    def _flush_accessed(self):
+        if self._accessed:
+            self._conn.executemany("UPDATE responses SET accessed=? WHERE key=?",
+                                   [(accessed, key) for key, accessed in self._accessed.items()])
+            self._accessed.clear()
+
+    def _evict(self):
+        if not self.max_bytes or self.total_bytes <= self.max_bytes:
+            return
+        self._flush_accessed()
+        while self.total_bytes > self.max_bytes:
+            oldest = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 100").fetchall()
+            if not oldest:
+                self.total_bytes = 0
+                break
+            for key, size in oldest:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM responses WHERE key=?", (key,))
+                self.total_bytes -= size
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes": self.total_bytes,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_accessed()
+            self._conn.commit()
+            self._conn.close()
+        logger.info(f'Terminology cache {self.filename} closed: {self.stats()}')
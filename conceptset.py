@@ -0,0 +1,84 @@
+"""
+   concept sets
+   An immutable set of SNOMED CT concept ids held as a sorted int64 array: 8 bytes a concept
+   rather than a Python string and hash table slot each, O(log n) membership for a single code
+   and vectorised membership for a whole column of codes
+"""
+
+import numpy as np
+
+
+## to_ids
+##   return an int64 array of the SNOMED CT ids in codes, codes that aren't ids become -1
+def to_ids(codes):
+    if isinstance(codes, np.ndarray) and codes.dtype == np.int64:
+        return codes
+    return np.fromiter((to_id(code) for code in codes), dtype=np.int64)
+
+
+## to_id
+##   return the SNOMED CT id code as an int, or -1 if it isn't one
+def to_id(code):
+    if isinstance(code, (int, np.integer)):
+        return int(code)
+    if isinstance(code, str) and code.isdigit() and len(code) <= 18:
+        return int(code)
+    return -1
+
+
+class ConceptSet:
+    """
+    Sorted, deduplicated SNOMED CT concept ids.  Codes go in and come out as strings, as they
+    are in FHIR responses, and ints are accepted too.
+    """
+    __slots__ = ('ids',)
+
+    def __init__(self, codes=()):
+        if isinstance(codes, ConceptSet):
+            self.ids = codes.ids
+            return
+        ids = to_ids(codes)
+        self.ids = np.unique(ids[ids >= 0])
+        self.ids.setflags(write=False)
+
+    @classmethod
+    def from_ids(cls, ids):
+        concepts = cls.__new__(cls)
+        concepts.ids = np.unique(np.asarray(ids, dtype=np.int64))
+        concepts.ids.setflags(write=False)
+        return concepts
+
+    def __contains__(self, code):
+        value = to_id(code)
+        if value < 0:
+            return False
+        i = self.ids.searchsorted(value)
+        return i < len(self.ids) and self.ids[i] == value
+
+    ## contains_many
+    ##   return a bool array, True where the code at that position of codes is in the set
+    def contains_many(self, codes):
+        ids = to_ids(codes)
+        if not len(self.ids):
+            return np.zeros(len(ids), dtype=bool)
+        i = np.minimum(self.ids.searchsorted(ids), len(self.ids) - 1)
+        return self.ids[i] == ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return (str(i) for i in self.ids.tolist())
+
+    def __or__(self, other):
+        return ConceptSet.from_ids(np.concatenate([self.ids, other.ids]))
+
+    def __eq__(self, other):
+        return isinstance(other, ConceptSet) and np.array_equal(self.ids, other.ids)
+
+    def __repr__(self):
+        return f'ConceptSet({len(self)} concepts)'
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes
@@ -1,25 +1,95 @@
 import logging
-import requests
 import urllib 
-import csv
+import requests
 import numpy as np
 import pandas as pd
 from urllib.parse import quote
-from fhirpathpy import evaluate
 import os
 import json
+import hashlib
+import threading
+import multiprocessing
+import time
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from helpers import init,path_exists
+# the procedures.txt and body_site_vs_id.txt readers live in helpers so lighter needn't import fetcher
+from helpers import read_focus_procedures,read_bodysite_vs_ids,procedures_digest
+from cache import TerminologyCache, DEFAULT_TTL, DEFAULT_MAX_BYTES
+from journal import Journal, read_manifest, write_manifest
+import termclient
+from termclient import get_client
+from conceptset import ConceptSet
+import metrics
 
 baseurl="https://r4.ontoserver.csiro.au/fhir"
 #baseurl="http://localhost:8080/fhir"
 system="http://snomed.info/sct"
 logger = logging.getLogger(__name__)        
+# Persistent response cache, set up by init_cache()
+cache = None
+# Local RF2 snapshot answering terminology queries instead of the server, set up by set_terminology()
+local = None
+# Codes per $expand page
+EXPAND_PAGE_SIZE = 1000
+
+## FHIRPath expressions applied to terminology responses.  The build reads them with the dict
+## walking extractors below, which return the same results without the FHIRPath engine;
+## fhirpath() evaluates any of them by name, compiling each once on first use.
+fhirpaths = {
+  "expansion_codes": "expansion.contains.code",
+  "subproperty_parts": "Parameters.parameter.where(name='property').part.where(name='subproperty').part"
+}
+compiled_fhirpaths = {}
+
+## fhirpath
+##   return the result of the named FHIRPath expression on data
+def fhirpath(name,data):
+  if name not in compiled_fhirpaths:
+    # fhirpathpy and its ANTLR runtime are only loaded if an expression is evaluated
+    from fhirpathpy import compile as compile_fhirpath
+    compiled_fhirpaths[name] = compile_fhirpath(fhirpaths[name])
+  return compiled_fhirpaths[name](data)
+
+## expansion_codes
+##   return expansion.contains.code of a ValueSet expansion
+def expansion_codes(data):
+  if not isinstance(data,dict):
+    return []
+  return [c["code"] for c in (data.get("expansion") or {}).get("contains",[]) if c.get("code") != None]
+
+## subproperty_parts
+##   return the parts of every subproperty of every property of a $lookup Parameters response
+def subproperty_parts(data):
+  if not isinstance(data,dict) or data.get("resourceType") != "Parameters":
+    return []
+  parts = []
+  for param in data.get("parameter",[]):
+    if param.get("name") == "property":
+      for part in param.get("part",[]):
+        if part.get("name") == "subproperty":
+          parts.extend(part.get("part",[]))
+  return parts
+
+## set_terminology
+## Choose where terminology queries go, either a FHIR terminology server base url
+## or local:/path/to/rf2 for an RF2 snapshot loaded into memory
+def set_terminology(spec):
+  global baseurl, local
+  if spec.startswith("local:"):
+    from rf2 import Rf2Snapshot
+    local = Rf2Snapshot(spec[len("local:"):])
+  elif spec != "":
+    baseurl = spec.rstrip('/')
+    local = None
+
 
 ## Checkserver is up
 def check_terminology_server():
+  if local != None:
+    return True
   query = "{0}/metadata".format(baseurl)
-  headers = {'Accept': 'application/fhir+json'}  
-  response = requests.get(query, headers=headers)
+  response = get_client().get(query)
   data = response.json()
   if data["status"] != "active":
     return False
@@ -57,87 +127,192 @@ def match_property_name(sct_code):
   return index  
 
 
+## get_snomed_version
+## Lookup the SNOMED CT root concept to find the edition/version the server is using
+## return the version uri or an empty string if the server doesn't say
+def get_snomed_version():
+  if local != None:
+    return local.version
+  query=baseurl+'/CodeSystem/$lookup?system='+urllib.parse.quote(system,safe='')+"&code=138875005"
+  response = get_client().get(query)
+  data = response.json()
+  for param in data.get("parameter",[]):
+    if param.get("name") == "version":
+      return param.get("valueString","")
+  return ""
+
+
+## init_cache
+## Open the persistent terminology cache, keyed to the server's current SNOMED CT version
+def init_cache(cachefile,ttl,max_bytes,version):
+  global cache
+  if cachefile == "" or local != None:
+    cache = None
+    return None
+  logger.info(f'Using terminology cache {cachefile} for SNOMED CT version {version}')
+  cache = TerminologyCache(cachefile,ttl=ttl,max_bytes=max_bytes,version=version)
+  return cache
+
+
+## fetch_json
+## GET a terminology server query, using the persistent cache when one is open
+## A request still throttled (429) or failing (5xx) after the client's retries raises requests.HTTPError,
+## so its OperationOutcome isn't taken for an answer; a 404 for an unknown code is returned as it is.
+## return a json response, only successful responses are cached
+def fetch_json(query):
+  if cache != None:
+    data = cache.get(query)
+    if data != None:
+      return data
+  response = get_client().get(query)
+  if response.status_code == 429 or response.status_code >= 500:
+    response.raise_for_status()
+  data = response.json()
+  if cache != None and response.status_code == 200:
+    cache.put(query,data)
+  return data
+
+
 ## get_valueset
 ## Generic Valueset getter, pass in a URL expression
+## With count, one page of count codes from offset is expanded, with only the expansion returned
 ## return a json response from the curl call
-def get_valueset(expr):
+def get_valueset(expr,offset=0,count=None):
+    if local != None:
+      return local.expand(expr,offset=offset,count=count)
     vsexp = baseurl + '/ValueSet/$expand?url='
     query = vsexp + quote(expr, safe='')
-    headers = {'Accept': 'application/fhir+json'}
-    response = requests.get(query, headers=headers)
-    data = response.json()
+    if count != None:
+      query += f'&offset={offset}&count={count}&includeDesignations=false&_elements=expansion'
+    data = fetch_json(query)
     return data
 
+## iter_valueset_codes
+## Expand a ValueSet a page of page_size codes at a time, so a large expansion is complete rather than
+## cut off at the server's expansion limit and only one page is held in memory
+## A page without an expansion raises ValueError with the server's response, rather than ending
+## the codes early and building from part of the set
+##   yield the expansion's codes in order as each page arrives
+def iter_valueset_codes(expr,page_size=None):
+  page_size = page_size or EXPAND_PAGE_SIZE
+  offset = 0
+  while True:
+    data = get_valueset(expr,offset,page_size)
+    expansion = data.get("expansion") if isinstance(data,dict) else None
+    if expansion == None:
+      raise ValueError(f'No expansion for {expr} at offset {offset}: {data}')
+    contains = expansion.get("contains",[])
+    yield from expansion_codes(data)
+    offset += len(contains)
+    total = expansion.get("total")
+    # stop at the total, or without one at a short page, or if the server returned nothing more
+    if not contains or (total != None and offset >= total) or (total == None and len(contains) < page_size):
+      return
+
+## get_valueset_codes
+##   return a ConceptSet of the codes in a ValueSet expansion, fetched page by page
+def get_valueset_codes(expr,page_size=None):
+  return ConceptSet(iter_valueset_codes(expr,page_size))
+
+## lookup_path
+## The relative CodeSystem lookup request for all properties of a code
+def lookup_path(code):
+  return 'CodeSystem/$lookup?system='+urllib.parse.quote(system,safe='')+"&code="+code+"&property=*"
+
+
 ## get_concept_all_props
 ## Perform a CodeSystem lookup and get all properties 
 ## return a json resposne from the curl call
 def get_concept_all_props(code):
-  cslookup='/CodeSystem/$lookup'  
-  query=baseurl+cslookup+'?system='+urllib.parse.quote(system,safe='')+"&code="+code+"&property=*"
-  headers = {'Accept': 'application/fhir+json'}  
-  response = requests.get(query, headers=headers)
-  data = response.json()
+  if local != None:
+    return local.lookup(code)
+  query=baseurl+'/'+lookup_path(code)
+  data = fetch_json(query)
   return data
 
 
-##
-## read procedures
-## read procedures concept (code and display) from a csv into an array
-def read_focus_procedures():
-  file_path = os.path.join('.','procedures.txt')
-  data = []
-  if not path_exists(file_path):
-    print(f'Fatal error: Procedures file {file_path} does not exist.')
-    return None
-  with open(file_path, 'r') as file:
-      reader = csv.reader(file)
-      for row in reader:
-          if row and row[0].startswith('#'):
-              continue
-          code, description = row
-          data.append((code, description))
-  return data
-
-
-##
-## read bodysite valueset id
-## read bodysite valueset name, valueset ids from csv keyed by ValueSet name into a dict
-def read_bodysite_vs_ids():
-  file_path = os.path.join('.','body_site_vs_id.txt')
-  data = {}
-  if not path_exists(file_path):
-    print(f'Fatal error: Procedures file {file_path} does not exist.')
-    return None
-  with open(file_path, 'r') as file:
-      reader = csv.reader(file)
-      for row in reader:
-          if row and row[0].startswith('#'):
-              continue
-          name, id = row
-          data[name] = id
-  return data
+## get_concept_props_batch
+## Perform the CodeSystem lookups for a list of codes as FHIR batch Bundles of chunk_size entries
+## Cached lookups are not sent, and a code whose batch entry fails falls back to a single lookup.
+## A batch that fails outright is treated as failed entries, and a code whose single lookup fails
+## too is left out of the result.
+##   return a dict of the lookup json responses keyed by code
+def get_concept_props_batch(codes,chunk_size=100):
+  if local != None:
+    return {code: local.lookup(code) for code in codes}
+  results = {}
+  pending = []
+  for code in codes:
+    data = cache.get(baseurl+'/'+lookup_path(code)) if cache != None else None
+    if data != None:
+      results[code] = data
+    elif code not in pending:
+      pending.append(code)
+  headers = {'Content-Type': 'application/fhir+json'}
+  for start in range(0,len(pending),chunk_size):
+    chunk = pending[start:start+chunk_size]
+    bundle = {
+      "resourceType": "Bundle",
+      "type": "batch",
+      "entry": [ {"request": {"method": "GET", "url": lookup_path(code)}} for code in chunk ]
+    }
+    logger.info(f'...Batch lookup of {len(chunk)} codes')
+    entries = []
+    try:
+      response = get_client().post(baseurl, json=bundle, headers=headers)
+      if response.status_code == 200:
+        entries = response.json().get("entry",[])
+      else:
+        logger.warning(f'Batch lookup returned {response.status_code}, falling back to single lookups')
+    except (requests.RequestException, ValueError) as e:
+      # a failed batch is the same as a batch of failed entries
+      logger.warning(f'Batch lookup failed: {e}, falling back to single lookups')
+    # batch-response entries are in the same order as the request entries
+    for code, entry in zip(chunk, entries):
+      status = entry.get("response",{}).get("status","")
+      if status.startswith("200") and "resource" in entry:
+        results[code] = entry["resource"]
+        if cache != None:
+          cache.put(baseurl+'/'+lookup_path(code),entry["resource"])
+    for code in chunk:
+      if code not in results:
+        try:
+          results[code] = get_concept_all_props(code)
+        except (requests.RequestException, ValueError) as e:
+          # left out, process_code looks it up again and logs and skips the row if that fails too
+          logger.warning(f'Lookup of {code} failed: {e}')
+  return results
+
+
+## build_procedure_index
+## Expand the descendants of each focus procedure once and index them back to the focus procedure
+## Focus procedures are indexed in procedures.txt order so a code below more than one of them
+## maps to the first, as the ancestor scan did.  Descendants exclude the focus procedure itself,
+## matching the `>code` ancestor expansion this replaces.
+##   return a dict of focus procedure codes keyed by descendant code
+def build_procedure_index(focus_procedures):
+  index = {}
+  if focus_procedures == None:
+    return index
+  for src,desc in focus_procedures:
+    ecl='http://snomed.info/sct?fhir_vs=ecl/<'+ src
+    for code in iter_valueset_codes(ecl):
+      index.setdefault(code,src)
+  logger.info(f'Indexed {len(index)} descendants of {len(focus_procedures)} focus procedures')
+  return index
 
 
 ## procedure mapper 
-## given a procedure code (proc), lookup the ancestors to see what the base procedure is
-## Get the ancestors and check to see if the match our list of common services/procedures/modalities
-def procedure_mapper(proc,map):
-  target = proc
-  ecl='http://snomed.info/sct?fhir_vs=ecl/>'+ proc
-  data = get_valueset(ecl)
-  concepts = evaluate(data,"expansion.contains.code")
-
-  if map != None:  
-    for src,desc in map:          
-      if src in concepts:
-        target=src
-        break    
-  return target
+## given a procedure code (proc), lookup the base procedure in the focus procedure index
+## built by build_procedure_index
+##   return the focus procedure, or proc itself if it isn't below any of them
+def procedure_mapper(proc,index):
+  return index.get(proc,proc)
 
 
 ##  get_body_structures
 ##  Get SNOMED Body Structure array, passing in a laterality
-##   return an array of SNOMED concept ids for lateralised Body Structures
+##   return a ConceptSet of the lateralised Body Structures
 def get_body_structures(laterality_name):
   bodystruct_id="123037004"
   laterality_qualifier_id="272741003"
@@ -145,47 +320,117 @@ def get_body_structures(laterality_name):
   laterality_id="7771000"
   if laterality_name not in ['left','right']:
     print("Error: Laterality name must be left or right")
-    return {}
+    return ConceptSet()
   else:
     if laterality_name == "right":
       laterality_id="24028007"
   ecl='http://snomed.info/sct?fhir_vs=ecl/<'+bodystruct_id+':'+laterality_qualifier_id+'='+laterality_id
-  data = get_valueset(ecl)
-  body_structures = evaluate(data,"expansion.contains.code")    
+  body_structures = get_valueset_codes(ecl)
   return body_structures
 
 ##  get_bilateral_procedures
 ##  Use an ECL expression to get all bilateral procedures
-##   return an array of SNOMED concept ids for bilateral Procedures
+##   return a ConceptSet of the bilateral Procedures
 def get_bilateral_procedures():
   ecl="< 71388002 : 405813007 = (*: 272741003= (24028007)), 405813007 = (*: 272741003= (7771000))"
   ecl_url='http://snomed.info/sct?fhir_vs=ecl/'+ecl
-  data = get_valueset(ecl_url)
-  bilateral = evaluate(data,"expansion.contains.code")
+  bilateral = get_valueset_codes(ecl_url)
   return bilateral
 
 
 
 ##  get_procedures_without_contrast
 ##  Use an ECL expression to get all `without contrast` procedures
-##   return an array of SNOMED concept ids for Procedures 'without contrast'
+##   return a ConceptSet of the Procedures 'without contrast'
 def get_procedures_without_contrast():
   ecl='< 71388002 {{ term = "without contrast" }}'
   ecl_url='http://snomed.info/sct?fhir_vs=ecl/'+ecl
-  data = get_valueset(ecl_url)
-  procs = evaluate(data,"expansion.contains.code")
+  procs = get_valueset_codes(ecl_url)
   return procs
 
 
+## SiteIndex
+## Lateralised body site to proximal primitive parent index, covering the left and right
+## body structure sets.  Sites are resolved with split_site the first time they're seen and
+## memoised, so each site costs one expansion per run however many services use it.  They
+## aren't resolved in bulk up front: that would be one expansion for every lateralised body
+## structure, where a build only uses a small fraction of them.
+class SiteIndex:
+  def __init__(self,left,right):
+    self.lateralised = len(left) + len(right)
+    self.sites = {}
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+
+  ## resolve
+  ##   return the de-lateralised site for code, or code itself if it has no primitive parent
+  def resolve(self,code):
+    with self._lock:
+      site = self.sites.get(code)
+      if site != None:
+        self.hits += 1
+        return site
+      self.misses += 1
+    with metrics.stage("split_site"):
+      site_array = split_site(code)
+    site = site_array[0] if site_array else code
+    with self._lock:
+      self.sites[code] = site
+    return site
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      "lateralised": self.lateralised,
+      "resolved": len(self.sites),
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+    }
+
+
+## TerminologyContext
+## The invariant concept sets for a build, fetched once per run rather than once per row
+class TerminologyContext:
+  def __init__(self,left,right,bilateral,without_contrast,focus_procedures,procedure_index=None):
+    # The concept sets are sorted int64 arrays, see conceptset.py
+    self.left = ConceptSet(left)
+    self.right = ConceptSet(right)
+    self.bilateral = ConceptSet(bilateral)
+    self.without_contrast = ConceptSet(without_contrast)
+    # Focus procedures keep the procedures.txt order, it's the priority order for mapping
+    self.focus_procedures = tuple(focus_procedures or [])
+    self.procedure_index = procedure_index or {}
+    self.site_index = SiteIndex(self.left,self.right)
+
+  @classmethod
+  def build(cls):
+    logger.info(f'Get Left sided Body Structures')
+    left = get_body_structures("left")
+    logger.info(f'Get Right sided Body Structures')
+    right = get_body_structures("right")
+    logger.info(f'Get bilateral procedures')
+    bilateral = get_bilateral_procedures()
+    logger.info(f'Get procedures without contrast')
+    without_contrast = get_procedures_without_contrast()
+    logger.info(f'Get focus procedures')
+    focus_procedures = read_focus_procedures()
+    logger.info(f'Index focus procedure descendants')
+    procedure_index = build_procedure_index(focus_procedures)
+    return cls(left,right,bilateral,without_contrast,focus_procedures,procedure_index)
+
+
 ## get_snomed_props
 ## Expand the defining relationships (properties) of the SNOMED CT Concept
+##   data is an optional lookup response already fetched by get_concept_props_batch
 ##   return a pandas data frame with the expanded properties 
-def get_snomed_props(code):
+def get_snomed_props(code,data=None):
   # Expand the properties for the SNOMED CT concept (code)
-  data=get_concept_all_props(code)
-  # Evaluate a fhirpath expression to get the Concept subproperties
-  expr="Parameters.parameter.where(name=\'property\').part.where(name=\'subproperty\').part"
-  parts = evaluate(data,expr)
+  if data == None:
+    data=get_concept_all_props(code)
+  # Get the Concept subproperties, see fhirpaths["subproperty_parts"]
+  parts = subproperty_parts(data)
   # Iterate through the subproperty parts to find the attribute values pairs (defining relationships)
   temp_list = []
   for elem in parts:    
@@ -205,20 +450,23 @@ def get_snomed_props(code):
 ##   return the de-lateralised concept (find the proximal primitive parent)
 def split_site(code):
   ecl='http://snomed.info/sct?fhir_vs=ecl/>! '+code+' {{ C definitionStatus = primitive }}'
-  data = get_valueset(ecl)
-  body_structure = evaluate(data,"expansion.contains.code")    
+  body_structure = list(iter_valueset_codes(ecl))
   return body_structure
 
 
 ## Separate lateralised body site into a body site column and a flag for left, right, both
-##  left_list and right_list are arrays of concepts that have the laterality listed in the name of that variable.
-def expand_body_site(df,left_list,right_list,focus_proc_list,fh):
+##  ctx is the TerminologyContext holding the left/right body structures, bilateral and
+##  without contrast procedures and the focus procedures for this run.
+##   return the tab separated rrs.txt row, or None if there is no base procedure
+def expand_body_site(df,ctx):
   sep="\t"
   pre_co=""
   procedure=""
   lat=""
   contrast=""
   site=""
+  # left and right membership for the whole TargetValue column at once
+  df = df.assign(Left=ctx.left.contains_many(df["TargetValue"]),Right=ctx.right.contains_many(df["TargetValue"]))
   sorted_props = df.sort_values(by=['TypeId'])
   for index, row in sorted_props.iterrows():
     # Procedure / Modality
@@ -229,33 +477,30 @@ def expand_body_site(df,left_list,right_list,focus_proc_list,fh):
     if row["TypeId"] == 1:    
       concept = row["TargetValue"]
       # Extract the laterality, rule is it's bilateral if in both left and right sets.    
-      if (concept in left_list):
+      if row["Left"]:
         lat="7771000"
-      elif (concept in right_list):
+      elif row["Right"]:
         lat="24028007"
       # If laterality exists, find the proximal primitive parent    
       site=row["TargetValue"]  
       if lat != "":  
-         site_array=split_site(concept)
-         if site_array:
-            site=site_array[0]  
+         site=ctx.site_index.resolve(concept)
     # Contrast = yes
     if row["TypeId"] == 3:
       contrast="373066001"
   # Fix any bilateral procedure lateralities
-  bilateral_procs = get_bilateral_procedures()
-  if pre_co in bilateral_procs:
+  if pre_co in ctx.bilateral:
     lat="51440002"
   # Get focus procedure code for the pre-coordinated concept
-  procedure = procedure_mapper(pre_co,focus_proc_list)
+  with metrics.stage("procedure_mapper"):
+    procedure = procedure_mapper(pre_co,ctx.procedure_index)
   # Check for procedures stating no contrast
-  procs_without_contrast = get_procedures_without_contrast()
-  if pre_co in procs_without_contrast:
+  if pre_co in ctx.without_contrast:
     contrast="373067005"
   if procedure==pre_co:
     print("ERROR: Unable to determine base radiological procedure for code: "+pre_co)
-  else:
-   fh.write("%s%s%s%s%s%s%s%s%s\n" % (
+    return None
+  return "%s%s%s%s%s%s%s%s%s\n" % (
         pre_co.strip(),
         sep,
         procedure.strip(),
@@ -266,54 +511,286 @@ def expand_body_site(df,left_list,right_list,focus_proc_list,fh):
         sep,
         contrast.strip()
     )
-)
+
+
+## process_code
+## Build the rrs.txt row for one target code, a failure is logged and skipped so one bad
+## row doesn't stop the run
+##   return the row, an empty string if the code has no row, or None if it failed
+def process_code(order_code,ctx,props=None):
+  try:
+    logger.info(f'...Get SCT props {order_code}')
+    with metrics.stage("get_snomed_props"):
+      rrs_df = get_snomed_props(order_code,props)
+    # Take the initial dataframes and further expand the body structure to add laterality
+    logger.info(f'...Expand body site for {order_code}')
+    with metrics.stage("expand_body_site"):
+      return expand_body_site(rrs_df,ctx) or ""
+  except Exception as e:
+    msg=f'ERROR: failed to process {order_code}: {e}'
+    logger.exception(msg)
+    print(msg)
+    return None
+
+## read_s2s
+## Stream the Snap2SNOMED export in chunks, reading only the columns needed.  Rows are filtered
+## to TARGET_EQUIVALENT and target codes deduplicated with vectorised masks and a hashed set.
+## If digest is a hashlib hash, every row's source code, target code and relationship type is fed
+## to it a chunk at a time, so the export can be compared with the last build's without keeping it.
+##   yield each unique equivalent target code in file order
+def read_s2s(s2sfile,digest=None,chunksize=50000):
+  columns = ["Source code","Target code","Relationship type code"]
+  seen = set()
+  reader = pd.read_csv(s2sfile,sep='\t',dtype=str,keep_default_na=False,
+                       usecols=lambda col: col in columns,chunksize=chunksize)
+  for chunk in reader:
+    if "Source code" not in chunk:
+      chunk["Source code"] = ""
+    if digest != None:
+      digest.update((chunk["Source code"]+"\t"+chunk["Target code"]+"\t"+chunk["Relationship type code"]+"\n").str.cat().encode())
+    targets = chunk["Target code"]
+    equivalent = targets[(chunk["Relationship type code"] == "TARGET_EQUIVALENT") & (targets != "")]
+    duplicate = equivalent.duplicated() | equivalent.isin(seen)
+    for index, order_code in equivalent[duplicate].items():
+      msg=f'...duplicate code detected at index:{index}... {order_code}, ignoring'
+      logger.warning(msg)
+      print(msg)
+    unique = equivalent[~duplicate].tolist()
+    seen.update(unique)
+    yield from unique
+
+
+## chunked
+##   yield lists of up to size items from iterable
+def chunked(iterable,size):
+  iterator = iter(iterable)
+  while True:
+    chunk = list(islice(iterator,size))
+    if not chunk:
+      return
+    yield chunk
+
+## write_rrs
+## Write rrs.txt, the row for each target code in order, codes without a row are left out
+def write_rrs(rrsfile,order,rows):
+  sep="\t"
+  fhRRS=init(rrsfile)
+  fhRRS.write("%s%s%s%s%s%s%s%s%s\n" % ("Service",sep,"Procedure",sep,"Site",sep,"Laterality",sep,"Contrast"))
+  for order_code in order:
+    line = rows.get(order_code)
+    if line:
+      fhRRS.write(line)
+  fhRRS.close()
+
+
+## shard_filename
+##   return the partial rrs file of shard index of count
+def shard_filename(outdir,index,count):
+  return os.path.join(outdir,"rrs.part-{0}-of-{1}.txt".format(index,count))
+
+
+## write_partial
+## Write a shard's rows with the position of each target code in the deduplicated code list, so
+## the shards can be merged back into input order.  A code without a row has an empty row.
+##   entries are (ordinal, code, row)
+def write_partial(filename,version,entries):
+  tmpfile = filename + ".tmp"
+  with open(tmpfile,"w") as fh:
+    fh.write("# {0}\n".format(version))
+    for ordinal, code, row in entries:
+      fh.write("{0}\t{1}\t{2}\n".format(ordinal,code,row.rstrip("\n")))
+  os.replace(tmpfile,filename)
+
+
+## read_partial
+##   return the SNOMED CT version and the (ordinal, code, row) entries of a partial rrs file
+def read_partial(filename):
+  entries = []
+  with open(filename) as fh:
+    version = fh.readline()[2:].rstrip("\n")
+    for line in fh:
+      ordinal, code, row = line.rstrip("\n").split("\t",2)
+      entries.append((int(ordinal),code,row + "\n" if row else ""))
+  return version, entries
+
+
+## merge_shards
+## Merge the partial files of count shards into rrs.txt and the build manifest, the same files a
+## serial run writes
+##   return the rrs.txt file
+def merge_shards(s2sfile,outdir,count):
+  versions = set()
+  entries = []
+  for index in range(count):
+    filename = shard_filename(outdir,index,count)
+    if not os.path.exists(filename):
+      raise FileNotFoundError(f'Shard {index} of {count} has not been built, {filename} is missing')
+    version, shard_entries = read_partial(filename)
+    versions.add(version)
+    entries.extend(shard_entries)
+  if len(versions) > 1:
+    raise ValueError(f'Shards were built against different SNOMED CT versions: {sorted(versions)}')
+  entries.sort()
+  sources = hashlib.sha256()
+  with metrics.stage("fetcher.read"):
+    order = list(read_s2s(s2sfile,sources))
+  rows = {code: row for ordinal, code, row in entries}
+  rrsfile = os.path.join(outdir,"rrs.txt")
+  write_rrs(rrsfile,order,rows)
+  write_manifest(os.path.join(outdir,"rrs.manifest.json"),versions.pop() if versions else "",procedures_digest(),sources.hexdigest(),
+                 {code: rows[code] for code in order if code in rows})
+  logger.info(f'Merged {count} shards, {len(entries)} of {len(order)} target codes, into {rrsfile}')
+  return rrsfile
+
+
+## run_shard
+## Build one shard in a worker process of run_sharded, logging as log_settings (logging.basicConfig
+## arguments) say so its lines reach the run's log file
+##   return the partial file, the shard's metrics snapshot and its request latencies
+def run_shard(terminology,client_settings,log_settings,s2sfile,outdir,shard,kwargs):
+  if log_settings:
+    logging.basicConfig(**log_settings)
+  # a pool process may build more than one shard, each reports only its own metrics
+  metrics.reset()
+  termclient.configure(**(client_settings or {}))
+  set_terminology(terminology)
+  partfile = run_main(s2sfile,outdir,shard=shard,**kwargs)
+  return {"file": partfile, "metrics": metrics.get_metrics().snapshot(), "latency": get_client().latency}
+
+
+## run_sharded
+## Build rrs.txt with the target codes split across processes worker processes, then merge them.
+## Each process sets up the terminology (see set_terminology), client (termclient.configure settings)
+## and logging (logging.basicConfig settings) itself; kwargs are passed on to run_main.  The shards'
+## stage timings, counters and request latencies are added to this process's metrics.
+##   return the rrs.txt file
+def run_sharded(s2sfile,outdir,processes,terminology="",client_settings=None,log_settings=None,**kwargs):
+  context = multiprocessing.get_context("spawn")
+  run = metrics.get_metrics()
+  with context.Pool(processes) as pool:
+    jobs = [pool.apply_async(run_shard,(terminology,client_settings,log_settings,s2sfile,outdir,(i,processes),kwargs))
+            for i in range(processes)]
+    for i, job in enumerate(jobs):
+      result = job.get()
+      run.merge(result["metrics"],f'shard{i}.')
+      get_client().merge_latency(result["latency"])
+      logger.info(f'Built {result["file"]}')
+  return merge_shards(s2sfile,outdir,processes)
+
 
 """
 Mainline
 """
 
-def run_main(s2sfile,outdir):
-  sep="\t"
+## run_main
+## Build rrs.txt from the Snap2SNOMED export
+##   shard (index, count) builds only the target codes whose position in the deduplicated code list
+##   is index modulo count, and writes them to a partial file for merge_shards instead of rrs.txt
+##   return the rrs.txt file, or the partial file for a shard
+def run_main(s2sfile,outdir,cachefile="",cache_ttl=DEFAULT_TTL,cache_size=DEFAULT_MAX_BYTES,workers=1,batch_size=100,resume=False,delta=False,shard=None):
   if not check_terminology_server():
     msg="Cannot continue as {0} appears to be down. 😭".format(baseurl)
     logger.error(msg)
     print(msg)
     exit
+  started = time.perf_counter()
   logger.info(f'create {outdir}')  
   files=create_filepath(s2sfile,outdir)
-  dupes = []
-  # Get Left sided body structures
-  logger.info(f'Get Left sided Body Structures')
-  left_list=get_body_structures("left")
-  # Get Right sided body structures
-  logger.info(f'Get Right sided Body Structures')
-  right_list=get_body_structures("right")
-  # Get list of focus procedures
-  logger.info(f'Get focus procedures')   
-  focus_procedures=read_focus_procedures()  
-  # Read in the Snap2SNOMED File
+  version=get_snomed_version()
+  init_cache(cachefile,cache_ttl,cache_size,version)
+  order = []
+  sources = hashlib.sha256()
+  # Get the body structure and procedure sets that are the same for every row
+  procedures=procedures_digest()
+  with metrics.stage("fetcher.context"):
+    ctx=TerminologyContext.build()
+  # Every built row is journaled as it completes, on resume the journaled codes are skipped
+  journal = Journal(os.path.join(outdir,"rrs.journal" if shard == None else "rrs.{0}-of-{1}.journal".format(*shard)),resume)
+  # A delta build carries over the rows of the previous build for target codes it already had
+  manifestfile = os.path.join(outdir,"rrs.manifest.json")
+  previous = {}
+  manifest = read_manifest(manifestfile) if delta else None
+  if delta:
+    if manifest == None:
+      logger.warning(f'No manifest {manifestfile} from a previous build, building everything')
+    elif manifest["snomed_version"] != version:
+      logger.warning(f'SNOMED CT version changed from {manifest["snomed_version"]} to {version}, building everything')
+    elif manifest.get("procedures_hash") != procedures:
+      # every row's Procedure is mapped through the focus procedures, see build_procedure_index
+      logger.warning(f'Focus procedures have changed since the last build, building everything')
+    else:
+      previous = manifest["rows"]
+  # Stream the Snap2SNOMED File, the equivalent target codes arrive deduplicated in file order
+  # so the work list (and so the row order) is the same however many workers run
   logger.info(f'Process Snap2SNOMED file: {files["s2sfile"]}')
-  data=pd.read_csv(files["s2sfile"],sep='\t',dtype={'Target code': str})
-  fhRRS=init(files["rrsfile"])
-  fhRRS.write("%s%s%s%s%s%s%s%s%s\n" % ("Service",sep,"Procedure",sep,"Site",sep,"Laterality",sep,"Contrast"))
-  # find the concepts marked as equivalent and extract the relationships / properties
-  for index, row in data.iterrows():
-    if row["Relationship type code"] == "TARGET_EQUIVALENT":
-        if row["Target code"] != "":
-          order_code = str(row["Target code"])
-          if order_code in dupes:
-            msg=f'...duplicate code detected at index:{index}... {order_code}, ignoring'
-            logger.warning(msg)
-            print(msg)
-            continue
-          else:
-            logger.info(f'...Get SCT props {order_code}')
-            rrs_df = get_snomed_props(order_code)  
-            # Take the initial dataframes and further expand the body structure to add laterality
-            logger.info(f'...Expand body site for {order_code}')
-            expand_body_site(rrs_df,left_list,right_list,focus_procedures,fhRRS)
-            dupes.append(order_code)
-  fhRRS.close()
+  # with batching on, the lookups for each chunk of codes are fetched in one batch Bundle first
+  chunk_size = batch_size if batch_size > 0 else max(workers,1)*10
+  executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+  if executor != None:
+    logger.info(f'Fetching with {workers} workers')
+  built = 0
+  carried = 0
+  chunks = chunked(read_s2s(files["s2sfile"],sources),chunk_size)
+  while True:
+    # reading and parsing the export, a chunk at a time
+    with metrics.stage("fetcher.read"):
+      chunk = next(chunks,None)
+    if chunk == None:
+      break
+    start = len(order)
+    order.extend(chunk)
+    if shard != None:
+      chunk = [code for k, code in enumerate(chunk,start) if k % shard[1] == shard[0]]
+    carry = [(code, previous[code]) for code in chunk if code in previous and code not in journal]
+    journal.record_many(carry)
+    carried += len(carry)
+    todo = [code for code in chunk if code not in journal]
+    if not todo:
+      continue
+    built += len(todo)
+    with metrics.stage("fetcher.properties"):
+      props = get_concept_props_batch(todo,batch_size) if batch_size > 0 else {}
+    # extract the relationships / properties
+    with metrics.stage("fetcher.rows"):
+      if executor != None:
+        rows = executor.map(lambda code: process_code(code,ctx,props.get(code)), todo)
+      else:
+        rows = (process_code(code,ctx,props.get(code)) for code in todo)
+      for order_code, line in zip(todo, rows):
+        if line != None:
+          journal.record(order_code,line)
+        else:
+          metrics.get_metrics().count("fetcher.failed")
+  if executor != None:
+    executor.shutdown()
+  logger.info(f'Built {built} of {len(order)} target codes')
+  if manifest != None and previous:
+    changed = "unchanged" if manifest.get("sources_hash") == sources.hexdigest() else "changed"
+    logger.info(f'Delta against previous build: Snap2SNOMED export {changed}, {carried} rows carried over')
+  journal.close()
+  if shard != None:
+    # merge_shards writes rrs.txt and the manifest once every shard is built
+    with metrics.stage("fetcher.write"):
+      outfile = shard_filename(outdir,*shard)
+      write_partial(outfile,version,[(k,code,journal.rows[code]) for k, code in enumerate(order)
+                                     if k % shard[1] == shard[0] and code in journal])
+    files["rrsfile"] = outfile
+  else:
+    # Write rrs.txt from the journal in input order.  Codes that failed aren't in the journal, so
+    # they're left out of the manifest too and the next delta build builds them again
+    with metrics.stage("fetcher.write"):
+      write_rrs(files["rrsfile"],order,journal.rows)
+      write_manifest(manifestfile,version,procedures,sources.hexdigest(),{code: journal.rows[code] for code in order if code in journal})
+  logger.info(f'Body site index: {ctx.site_index.stats()}')
+  logger.info(f'Terminology server latency: {get_client().stats()}')
+  run = metrics.get_metrics()
+  run.gauge("fetcher.codes",len(order))
+  run.gauge("fetcher.built",built)
+  run.gauge("fetcher.rows_per_second",round(len(order)/(time.perf_counter()-started),1))
+  run.gauge("site_index",ctx.site_index.stats())
+  if cache != None:
+    run.gauge("cache",cache.stats())
+    cache.close()
   logger.info(f'Finished building RRS flat file: {files["rrsfile"]}') 
   return files["rrsfile"]
        
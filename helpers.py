@@ -1,6 +1,13 @@
+import csv
+import hashlib
+import json
 import os
-from fhirclient import client
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from termclient import get_client
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 def path_exists(path):
     if os.path.exists(path):
@@ -13,6 +20,54 @@ def init(filename):
     fh = open(filename, "w+")
     return fh 
 
+# The focus procedures every rrs.txt Procedure column is mapped to
+PROCEDURES_FILE = os.path.join('.','procedures.txt')
+
+##
+## read procedures
+## read procedures concept (code and display) from a csv into an array
+def read_focus_procedures():
+    file_path = PROCEDURES_FILE
+    data = []
+    if not path_exists(file_path):
+        print(f'Fatal error: Procedures file {file_path} does not exist.')
+        return None
+    with open(file_path, 'r') as file:
+        reader = csv.reader(file)
+        for row in reader:
+            if row and row[0].startswith('#'):
+                continue
+            code, description = row
+            data.append((code, description))
+    return data
+
+
+##
+## procedures_digest
+##   return the sha256 of the focus procedures file, or an empty string if there isn't one
+def procedures_digest():
+    if not os.path.exists(PROCEDURES_FILE):
+        return ""
+    with open(PROCEDURES_FILE, 'rb') as fh:
+        return hashlib.sha256(fh.read()).hexdigest()
+
+## read bodysite valueset id
+## read bodysite valueset name, valueset ids from csv keyed by ValueSet name into a dict
+def read_bodysite_vs_ids():
+    file_path = os.path.join('.','body_site_vs_id.txt')
+    data = {}
+    if not path_exists(file_path):
+        print(f'Fatal error: Procedures file {file_path} does not exist.')
+        return None
+    with open(file_path, 'r') as file:
+        reader = csv.reader(file)
+        for row in reader:
+            if row and row[0].startswith('#'):
+                continue
+            name, id = row
+            data[name] = id
+    return data
+
 ## 
 #    Validate a resource
 #    Create a request to onto r4 for validating the ValueSet and ConceptMap resources
@@ -24,6 +79,184 @@ def validate_resource(data,resource_type,endpoint):
             }
     validate_url = "{0}/{1}/$validate".format(settings['api_base'],resource_type)
     #smart = client.FHIRClient(settings=settings)
-    response = requests.post(validate_url, json=data)
+    response = get_client().post(validate_url, json=data)
     return response.status_code
 
+
+
+## Verhoeff check digit tables, SNOMED CT identifiers end in a Verhoeff check digit
+verhoeff_d = [
+    [0,1,2,3,4,5,6,7,8,9],[1,2,3,4,0,6,7,8,9,5],[2,3,4,0,1,7,8,9,5,6],[3,4,0,1,2,8,9,5,6,7],[4,0,1,2,3,9,5,6,7,8],
+    [5,9,8,7,6,0,4,3,2,1],[6,5,9,8,7,1,0,4,3,2],[7,6,5,9,8,2,1,0,4,3],[8,7,6,5,9,3,2,1,0,4],[9,8,7,6,5,4,3,2,1,0]
+]
+verhoeff_p = [
+    [0,1,2,3,4,5,6,7,8,9],[1,5,7,6,2,8,3,0,9,4],[5,8,0,3,7,9,6,1,4,2],[8,9,1,6,0,4,3,5,2,7],
+    [9,4,5,3,1,2,6,8,7,0],[4,2,8,6,5,7,3,9,0,1],[2,7,9,3,8,0,6,4,1,5],[7,0,4,6,9,1,3,2,5,8]
+]
+verhoeff_inv = [0,4,3,2,1,5,6,7,8,9]
+
+## verhoeff_digit
+#    return the Verhoeff check digit for a string of digits
+def verhoeff_digit(digits):
+    check = 0
+    for i, ch in enumerate(reversed(digits)):
+        check = verhoeff_d[check][verhoeff_p[(i + 1) % 8][int(ch)]]
+    return str(verhoeff_inv[check])
+
+## make_sctid
+#    return a SNOMED CT identifier from an item identifier and partition id e.g. "00" for a concept
+def make_sctid(item, partition="00"):
+    digits = "{0}{1}".format(item, partition)
+    return digits + verhoeff_digit(digits)
+
+## is_sctid
+#    return True if code is a syntactically valid SNOMED CT identifier: 6 to 18 digits, no leading zero
+#    and a correct Verhoeff check digit
+def is_sctid(code):
+    if not isinstance(code, str) or not code.isdigit() or not 6 <= len(code) <= 18 or code[0] == "0":
+        return False
+    return verhoeff_digit(code[:-1]) == code[-1]
+
+
+## dumps_json
+#    Serialise a FHIR resource dict.
+#    The default is the same text as json.dumps(data, indent=2); compact drops the indentation and spaces.
+#    orjson is used when it's installed and the document is ASCII, json escapes anything else
+def dumps_json(data, compact=False):
+    if orjson is not None:
+        text = orjson.dumps(data, option=0 if compact else orjson.OPT_INDENT_2)
+        if text.isascii():
+            return text.decode('ascii')
+    if compact:
+        return json.dumps(data, separators=(',', ':'))
+    return json.dumps(data, indent=2)
+
+## dump_json
+#    Write a FHIR resource dict to an open text file, see dumps_json
+def dump_json(data, fh, compact=False):
+    fh.write(dumps_json(data, compact))
+
+## stream_json
+#    Write a FHIR resource dict to an open text file with one of its lists supplied by an iterable,
+#    so the list is never held in memory.  The list's place in data holds the string marker.
+#    The text is the same as dump_json would write for the complete resource
+def stream_json(data, fh, marker, items, compact=False):
+    prefix, suffix = dumps_json(data, compact).split(json.dumps(marker), 1)
+    fh.write(prefix)
+    if compact:
+        separator, start, end = ',', '[', ']'
+    else:
+        # indent the items one level deeper than the line holding the list's key
+        line = prefix[prefix.rfind('\n') + 1:]
+        indent = ' ' * (len(line) - len(line.lstrip(' ')))
+        separator, start, end = ',\n' + indent + '  ', '[\n' + indent + '  ', '\n' + indent + ']'
+    first = True
+    for item in items:
+        text = dumps_json(item, compact)
+        if not compact:
+            text = text.replace('\n', '\n' + indent + '  ')
+        fh.write((start if first else separator) + text)
+        first = False
+    fh.write('[]' if first else end)
+    fh.write(suffix)
+
+## HashingWriter
+#    A text file wrapper that keeps the SHA-256 of everything written through it
+class HashingWriter:
+    def __init__(self, fh):
+        self.fh = fh
+        self.sha = hashlib.sha256()
+
+    def write(self, text):
+        self.sha.update(text.encode('utf-8'))
+        self.fh.write(text)
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+sct = "http://snomed.info/sct"
+required_elements = {
+    "ValueSet": ["url", "status"],
+    "ConceptMap": ["url", "status", "group"],
+    "CodeSystem": ["url", "status", "content"]
+}
+
+def issue(severity, code, diagnostics):
+    return {"severity": severity, "code": code, "diagnostics": diagnostics}
+
+## check_resource
+#    Local structural checks of a ValueSet, ConceptMap or CodeSystem before it is sent to $validate:
+#    required elements, SNOMED CT code syntax and duplicate ConceptMap elements.
+#    return a list of OperationOutcome issues, any "error" issue means the resource is broken
+def check_resource(data):
+    issues = []
+    resource_type = data.get("resourceType")
+    if resource_type not in required_elements:
+        return [issue("error", "structure", f'Unexpected resourceType {resource_type}')]
+    for element in required_elements[resource_type]:
+        if not data.get(element):
+            issues.append(issue("error", "required", f'{resource_type}.{element} is required'))
+
+    def check_code(path, system, code):
+        if system == sct and not is_sctid(code):
+            issues.append(issue("error", "code-invalid", f'{path} {code!r} is not a valid SNOMED CT identifier'))
+
+    if resource_type == "ValueSet":
+        for i, include in enumerate((data.get("compose") or {}).get("include", [])):
+            for concept in include.get("concept", []):
+                check_code(f'ValueSet.compose.include[{i}].concept.code', include.get("system"), concept.get("code"))
+    elif resource_type == "ConceptMap":
+        for i, group in enumerate(data.get("group") or []):
+            if not group.get("element"):
+                issues.append(issue("error", "required", f'ConceptMap.group[{i}].element is required'))
+            seen = set()
+            for j, element in enumerate(group.get("element") or []):
+                path = f'ConceptMap.group[{i}].element[{j}]'
+                check_code(path + '.code', group.get("source"), element.get("code"))
+                for target in element.get("target", []):
+                    check_code(path + '.target.code', group.get("target"), target.get("code"))
+                    if not target.get("equivalence"):
+                        issues.append(issue("error", "required", f'{path}.target.equivalence is required'))
+                    for dep in target.get("dependsOn", []):
+                        check_code(path + '.target.dependsOn.value', dep.get("system"), dep.get("value"))
+                key = json.dumps(element, sort_keys=True)
+                if key in seen:
+                    issues.append(issue("warning", "duplicate", f'{path} duplicates an earlier element'))
+                seen.add(key)
+    elif resource_type == "CodeSystem":
+        # a supplement of SNOMED CT has SNOMED CT concepts
+        system = (data.get("supplements") or data.get("url") or "").split("|")[0]
+        for concept in data.get("concept", []):
+            check_code('CodeSystem.concept.code', system, concept.get("code"))
+    return issues
+
+## validate_one
+#    Check a resource file locally, then with the server's $validate if it passed and there is an endpoint
+#    return (valid, issues)
+def validate_one(filename, endpoint):
+    with open(filename) as f:
+        data = json.load(f)
+    issues = check_resource(data)
+    if any(i["severity"] == "error" for i in issues):
+        return False, issues
+    if not endpoint:
+        return True, issues
+    validate_url = "{0}/{1}/$validate".format(endpoint.rstrip('/'), data["resourceType"])
+    response = get_client().post(validate_url, json=data)
+    try:
+        outcome = response.json()
+    except ValueError:
+        outcome = {}
+    server_issues = outcome.get("issue", []) if outcome.get("resourceType") == "OperationOutcome" else []
+    issues = issues + server_issues
+    valid = response.ok and not any(i.get("severity") in ("error", "fatal") for i in server_issues)
+    return valid, issues
+
+## validate_files
+#    Validate artefact files concurrently over the shared pooled client
+#    return {filename: (valid, issues)}
+def validate_files(files, endpoint="", workers=8):
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(files) or 1))) as executor:
+        results = executor.map(lambda filename: validate_one(filename, endpoint), files)
+        return dict(zip(files, results))
@@ -0,0 +1,139 @@
+"""
+   build journal
+   Append-only record of the rrs.txt row built for each target code, flushed to disk after
+   every row so an interrupted fetcher run can resume where it stopped, the manifest of
+   a finished build that a delta build compares against, and the manifest of the FHIR
+   artefacts lighter wrote and published
+"""
+
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """
+    One JSON line per processed target code: {"code": ..., "row": ...}.
+    row is the rrs.txt line, or an empty string if the code produced no row.
+    Opening with resume=False starts a new journal, resume=True loads the rows already
+    recorded and appends to them.
+    """
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.rows = {}
+        if resume and os.path.exists(filename):
+            complete = 0
+            with open(filename, "rb") as fh:
+                for line in fh:
+                    if not line.endswith(b"\n"):
+                        # a torn final line from a crash mid-write, that code is redone
+                        logger.warning(f'Ignoring incomplete journal entry in {filename}')
+                        break
+                    complete += len(line)
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logger.warning(f'Ignoring unreadable journal entry in {filename}')
+                        continue
+                    self.rows[entry["code"]] = entry["row"]
+            # cut the torn line off so the next entry starts on a line of its own
+            if complete < os.path.getsize(filename):
+                os.truncate(filename, complete)
+            logger.info(f'Resuming from {filename} with {len(self.rows)} codes already built')
+        self.fh = open(filename, "a" if resume else "w")
+
+    def __contains__(self, code):
+        return code in self.rows
+
+    def record(self, code, row):
+        self.rows[code] = row
+        self.fh.write(json.dumps({"code": code, "row": row}) + "\n")
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    ## record_many
+    ## Record rows carried over from elsewhere, e.g. a previous build, with a single flush
+    def record_many(self, rows):
+        if not rows:
+            return
+        for code, row in rows:
+            self.rows[code] = row
+            self.fh.write(json.dumps({"code": code, "row": row}) + "\n")
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def close(self):
+        self.fh.close()
+
+
+## read_manifest
+##   return the manifest of the last successful build, or None if there isn't one
+def read_manifest(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as fh:
+        return json.load(fh)
+
+
+## write_manifest
+## Record what a successful build was made from: the SNOMED CT version, the sha256 of the focus
+## procedures file, the sha256 of the Snap2SNOMED (source code, target code, relationship type)
+## rows and the rrs.txt row for each target code
+def write_manifest(filename, version, procedures, sources, rows):
+    manifest = {
+        "snomed_version": version,
+        "procedures_hash": procedures,
+        "sources_hash": sources,
+        "rows": rows
+    }
+    tmpfile = filename + ".tmp"
+    with open(tmpfile, "w") as fh:
+        json.dump(manifest, fh)
+    os.replace(tmpfile, filename)
+
+
+class ArtefactManifest:
+    """
+    Content hash of each FHIR artefact file written by the last lighter build, and the hash and
+    server version last published to each endpoint, keyed by file name.
+    check_server asks the server whether its copy changed before skipping an unchanged artefact.
+    """
+
+    def __init__(self, filename, check_server=False):
+        self.filename = filename
+        self.check_server = check_server
+        previous = read_manifest(filename) or {}
+        self.artefacts = previous.get("artefacts", {})
+
+    def hash(self, name):
+        return self.artefacts.get(name, {}).get("hash")
+
+    ## record
+    ## Record an artefact file's content hash and, as {"resourceType": ..., "id": ..., "url": ...},
+    ## the resource it holds, so it can be published without reading the file back
+    def record(self, name, digest, resource=None):
+        entry = self.artefacts.setdefault(name, {})
+        entry["hash"] = digest
+        if resource is not None:
+            entry["resource"] = resource
+
+    def resource(self, name):
+        return self.artefacts.get(name, {}).get("resource")
+
+    ## published
+    ##   return {"hash": ..., "versionId": ...} for the copy last published to endpoint, or None
+    def published(self, name, endpoint):
+        return self.artefacts.get(name, {}).get("published", {}).get(endpoint)
+
+    def record_published(self, name, endpoint, digest, version_id=None):
+        entry = self.artefacts.setdefault(name, {}).setdefault("published", {})
+        entry[endpoint] = {"hash": digest, "versionId": version_id}
+
+    def save(self):
+        tmpfile = self.filename + ".tmp"
+        with open(tmpfile, "w") as fh:
+            json.dump({"artefacts": self.artefacts}, fh, indent=2, sort_keys=True)
+        os.replace(tmpfile, self.filename)
@@ -2,14 +2,21 @@
    fhir lighter library for building the fhir artefacts from the TSV input file 
 """
 
+import csv
+import gzip
 import json
-import numpy as np
-import pandas as pd
+import math
+import shutil
+from collections import namedtuple
+from urllib.parse import quote
 import logging
 from fhirclient.models import valueset,conceptmap,codesystem
 from fhirclient import client
-from helpers import path_exists 
-from fetcher import read_focus_procedures, read_bodysite_vs_ids
+from helpers import path_exists, dump_json, stream_json, HashingWriter, validate_files
+from helpers import read_focus_procedures, read_bodysite_vs_ids
+from journal import ArtefactManifest
+from termclient import get_client
+import metrics
 import os
 
 logger = logging.getLogger(__name__)
@@ -40,12 +47,71 @@ def get_template_files(templates_path):
     ]    
     return template_filepath
 
+## RrsRow
+#    One row of rrs.txt, missing values are empty strings
+RrsRow = namedtuple('RrsRow', ['Service', 'Procedure', 'Site', 'Laterality', 'Contrast'])
+
+class RrsTable:
+    """
+    rrs.txt parsed once and shared by every builder.
+    rows is a tuple of RrsRow, columns holds the unique values of each of the five
+    columns in order of first appearance, gathered in the same single pass.
+    """
+    __slots__ = ('filename', 'rows', 'columns')
+
+    def __init__(self, filename, rows, columns):
+        object.__setattr__(self, 'filename', filename)
+        object.__setattr__(self, 'rows', rows)
+        object.__setattr__(self, 'columns', columns)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('RrsTable is immutable')
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+## iter_rrs
+#    Read rrs.txt one RrsRow at a time
+def iter_rrs(rrsfile):
+    with open(rrsfile, newline='') as f:
+        reader = csv.reader(f, delimiter='\t')
+        header = next(reader, [])
+        index = [header.index(field) if field in header else None for field in RrsRow._fields]
+        for values in reader:
+            if not values:
+                continue
+            yield RrsRow(*[values[i] if i is not None and i < len(values) else '' for i in index])
+
+## load_rrs
+#    Read rrs.txt into an RrsTable
+def load_rrs(rrsfile):
+    rows = []
+    seen = [dict() for field in RrsRow._fields]
+    for row in iter_rrs(rrsfile):
+        rows.append(row)
+        for col, value in enumerate(row):
+            seen[col].setdefault(value, None)
+    columns = tuple(tuple(s) for s in seen)
+    logger.info(f'Loaded {len(rows)} rows from {rrsfile}')
+    return RrsTable(rrsfile, tuple(rows), columns)
+
+## as_rrs_table
+#    Builders take either a loaded RrsTable or the rrs.txt file name
+def as_rrs_table(rrs):
+    if isinstance(rrs, RrsTable):
+        return rrs
+    return load_rrs(rrs)
+
 ## check_numeric
-#    return true if the pandas frame is numeric and not a float else return false
+#    return true if the value is present and not a float else return false
+#    (a float is NaN, or a code pandas misread as a number)
 def is_numeric(value):
-    if pd.isna(value):
+    if value is None or value == "" or (isinstance(value, float) and math.isnan(value)):
         return False
-    elif isinstance(value, np.float64):
+    elif isinstance(value, float):
         print("value is a float {0}".format(value))
         return False
     else:
@@ -62,15 +128,15 @@ def create_client(endpoint):
     return smart
    
 
-def build_valueset(col,template,infile,outfile,smart):
+def build_valueset(col,template,rrs,outfile,smart,compact=False,manifest=None):
     """
-    Build a FHIR ValueSet based on the input file, template file and output to outfile
-    col is an integer that describes which column 0..3 in the input file to work from
+    Build a FHIR ValueSet based on the RRS table (or rrs.txt file), template file and output to outfile
+    col is an integer that describes which column 0..4 in the input file to work from
     """
-    df=pd.read_csv(infile,sep='\t',dtype={'Service':str,'Procedure':str,'Site':str,'Laterality':str,'Contrast':str})
+    table=as_rrs_table(rrs)
    
     # Get values from the required column
-    concepts=df.iloc[:,col].astype(str).unique()
+    concepts=table.columns[col]
     # Get the ValueSet template as a ValueSet object
     # Read the FHIR ValueSet JSON file into a Python dictionary
     with open(template) as f:
@@ -103,45 +169,35 @@ def build_valueset(col,template,infile,outfile,smart):
             vs.compose.include[0].concept.append(include_concept)
 
     # Export the Valueset to file for manual review
-    with open(outfile, "w") as f:
-        json.dump(vs.as_json(), f, indent=2)
-    # Cleanup
-    df.drop(df.index, inplace=True)
+    write_resource(outfile, vs.as_json(), compact, manifest)
     if smart != None:
-        if vs.id:
-            response = vs.update(smart.server)
-        else:
-            response = vs.create(smart.server)
-        if response:
-            return 201
-        else:
-            return 500
+        return publish_file(smart, "ValueSet", vs.id, outfile, manifest)
     else:
         return 200
 
-def build_bodysite_valuesets(infile,outdir,smart,templates_path):
+def build_bodysite_valuesets(rrs,outdir,smart,templates_path,compact=False,manifest=None):
     """
-    Build BodySite ValueSets based on the input file for each modality, template file and output to outdir.
+    Build BodySite ValueSets based on the RRS table (or rrs.txt file) for each modality, template file and output to outdir.
+    Returns the ValueSet files written
     """
-    df = pd.read_csv(infile, sep='\t', dtype={'Service': str, 'Procedure': str, 'Site': str, 'Laterality': str, 'Contrast': str})
+    table = as_rrs_table(rrs)
     template = os.path.join('.',templates_path,'ValueSet-radiology-modaility-body-site-template.json')
     # Get list of focus procedures:  which are code, display pairs
     focus_procedures=read_focus_procedures() 
     # Create a dict of Value set ids keyed by procedure name 
     bodysite_vs_id=read_bodysite_vs_ids()  
-    # Get unique Procedures
-    unique_procedures = df['Procedure'].unique()
+    # Get unique Sites for each Procedure, in one pass over the table
+    procedure_sites = {}
+    for row in table:
+        procedure_sites.setdefault(row.Procedure, {}).setdefault(row.Site, None)
     
     # Read the FHIR ValueSet JSON template file into a Python dictionary
     with open(template) as f:
         meta = json.load(f)
     
-    for procedure in unique_procedures:
-        # Filter the dataframe for the current procedure
-        procedure_df = df[df['Procedure'] == procedure]
-        
-        # Get unique Sites for the current procedure
-        unique_sites = procedure_df['Site'].astype(str).unique()
+    outfiles = []
+    for procedure, sites in procedure_sites.items():
+        unique_sites = list(sites)
         
         # Build a friendly nametag for the ValueSet
         for code,desc in focus_procedures:          
@@ -183,38 +239,189 @@ def build_bodysite_valuesets(infile,outdir,smart,templates_path):
         
         # Export the ValueSet to file for manual review
         outfile = os.path.join(outdir, f"ValueSet-{proc_name_vs}.json")
-        with open(outfile, "w") as f:
-            json.dump(vs.as_json(), f, indent=2)
+        write_resource(outfile, vs.as_json(), compact, manifest)
+        outfiles.append(outfile)
         response = ""
         if smart != None:
-            if vs.id:
-                response = vs.update(smart.server)
-            else:
-                response = vs.create(smart.server)
+            response = publish_file(smart, "ValueSet", vs.id, outfile, manifest)
         msg = f'Built Custom BodySite ValueSet: {proc_name_vs}. {response}'
         print(msg)
         logger.info(msg)     
+    return outfiles
 
 
 
-def build_concept_map(rrsfile,outdir,smart,templates_path):
+def build_concept_map(rrs,outdir,smart,templates_path,compact=False,manifest=None):
     """
     Build a concept map of procedures and other qualifiers in a property/dependsOn style 
     to a radiology service code (fully defined)
+    The map elements are built as plain dicts straight from the RRS rows and streamed to the file
+    one at a time, given a file name rather than an RrsTable the rows are streamed too.
+    The fhirclient model is only used for the resource header
     """
     print(f'...Building ConceptMap')
     mapfile = os.path.join(outdir,"ConceptMap_RadiologyServices.json")
-    df=pd.read_csv(rrsfile,sep='\t',dtype={'Service':str,'Procedure':str,'Site':str,'Laterality':str,'Contrast':str})
+    rows = rrs if isinstance(rrs, RrsTable) else iter_rrs(rrs)
     # Read the FHIR ConceptMap JSON file into a Python dictionary
     template =  os.path.join('.',templates_path,'ConceptMap-radiology-services-template.json')
     print("Processing ConceptMap template...{0}".format(template))
-    prop_modality =  "FocalProcedure"
-    prop_site = "BodySite"
-    prop_laterality = "Laterality"
-    prop_contrast = "Contrast"
     with open(template) as f:
        meta = json.load(f)
-     # Create a FHIR ConceptMap resource object
+    data = concept_map_header(meta)
+    marker = "__streamed_elements__"
+    data["group"][0]["element"] = marker
+    # add map elements
+    #    0 : Service (Full code), 1: Procedure, 2: Site , 3: Laterality, 4: Contrast (yes/no)
+    elements = (concept_map_element(row) for row in rows if is_numeric(row.Service))
+    # Dump the ConceptMap to file for manual review
+    write_resource(mapfile, data, compact, manifest, marker, elements)
+    if smart != None:
+        return publish_file(smart, "ConceptMap", data.get("id"), mapfile, manifest)
+    else:
+        return 200
+
+
+## write_resource
+#    Write a resource file through a temporary file.  If its content hash matches the last build's the
+#    existing file is left as it is.  marker and items stream one of the resource's lists, see stream_json
+#    return the content hash
+def write_resource(filename, data, compact=False, manifest=None, marker=None, items=None):
+    tmpfile = filename + ".tmp"
+    with open(tmpfile, "w") as f:
+        out = HashingWriter(f)
+        if marker is None:
+            dump_json(data, out, compact)
+        else:
+            stream_json(data, out, marker, items, compact)
+    digest = out.hexdigest()
+    name = os.path.basename(filename)
+    if manifest is not None and manifest.hash(name) == digest and os.path.exists(filename):
+        os.remove(tmpfile)
+        logger.info(f'{name} is unchanged')
+    else:
+        os.replace(tmpfile, filename)
+    if manifest is not None:
+        manifest.record(name, digest, resource_info(data))
+    return digest
+
+
+## resource_info
+#    The resourceType, id and canonical url of a resource, all a transaction entry needs besides its text
+def resource_info(data):
+    return {"resourceType": data.get("resourceType"), "id": data.get("id"), "url": data.get("url")}
+
+
+## needs_publish
+#    False if this content was already published to the server.  With manifest.check_server the server
+#    is asked, with If-None-Match on the version published, whether its copy has changed since
+def needs_publish(smart, resource_type, id, filename, manifest):
+    if manifest is None:
+        return True
+    name = os.path.basename(filename)
+    published = manifest.published(name, smart.server.base_uri)
+    if not published or published["hash"] != manifest.hash(name):
+        return True
+    if manifest.check_server and id and published.get("versionId"):
+        url = f'{smart.server.base_uri.rstrip("/")}/{resource_type}/{id}'
+        response = get_client().get(url, headers={'If-None-Match': f'W/"{published["versionId"]}"'})
+        if response.status_code != 304:
+            logger.info(f'{resource_type}/{id} has changed on the server, republishing')
+            return True
+    return False
+
+
+## version_id
+#    The version the server gave a written resource, from its ETag or meta.versionId
+def version_id(etag, resource):
+    if etag:
+        return etag.replace('W/', '').strip('"')
+    return ((resource or {}).get("meta") or {}).get("versionId")
+
+
+## publish_file
+#    PUT (or POST without an id) a resource file to the server, streaming the file rather than loading it.
+#    Skipped, returning 200, if the manifest shows this content is already on the server
+def publish_file(smart, resource_type, id, filename, manifest=None):
+    # timed as lighter.publish, as a transaction is, within the stage of the builder that calls it
+    with metrics.stage("lighter.publish"):
+        return _publish_file(smart, resource_type, id, filename, manifest)
+
+def _publish_file(smart, resource_type, id, filename, manifest):
+    if not needs_publish(smart, resource_type, id, filename, manifest):
+        logger.info(f'{resource_type}/{id} is already published')
+        return 200
+    url = smart.server.base_uri.rstrip('/') + '/' + resource_type
+    headers = {'Content-Type': 'application/fhir+json'}
+    with open(filename, 'rb') as fh:
+        if id:
+            response = get_client().put(f'{url}/{id}', data=fh, headers=headers)
+        else:
+            response = get_client().post(url, data=fh, headers=headers)
+    if response.ok:
+        if manifest is not None:
+            name = os.path.basename(filename)
+            manifest.record_published(name, smart.server.base_uri, manifest.hash(name),
+                                      version_id(response.headers.get('ETag'), None))
+        return 201
+    logger.error(f'Publishing {filename} returned {response.status_code}: {response.text}')
+    return 500
+
+
+## publish_transaction
+#    Publish artefact files as one gzip compressed transaction Bundle of conditional PUTs by canonical url,
+#    so the server is updated with all of them or none.  The Bundle is streamed to outdir and then to the server.
+#    Each file's resourceType, id and url come from the manifest, a file the manifest doesn't know is read once.
+#    Artefacts the manifest shows are already on the server are left out
+def publish_transaction(smart, files, outdir, manifest=None):
+    resources = []
+    for filename in files:
+        info = manifest.resource(os.path.basename(filename)) if manifest is not None else None
+        if info is None:
+            with open(filename) as f:
+                info = resource_info(json.load(f))
+        if needs_publish(smart, info["resourceType"], info.get("id"), filename, manifest):
+            resources.append((filename, info))
+    if not resources:
+        logger.info(f'All {len(files)} artefacts are already published')
+        return 200
+    bundlefile = os.path.join(outdir, "Bundle-publish.json.gz")
+    with gzip.open(bundlefile, "wt") as f:
+        write_transaction(f, resources)
+    headers = {'Content-Type': 'application/fhir+json', 'Content-Encoding': 'gzip'}
+    with open(bundlefile, 'rb') as fh:
+        response = get_client().post(smart.server.base_uri.rstrip('/'), data=fh, headers=headers)
+    if not response.ok:
+        logger.error(f'Publishing transaction of {len(resources)} artefacts returned {response.status_code}: {response.text}')
+        return 500
+    # transaction-response entries are in the same order as the request entries
+    for (filename, info), entry in zip(resources, response.json().get("entry", [])):
+        result = entry.get("response", {})
+        logger.info(f'Published {result.get("location", "")} {result.get("status", "")}')
+        if manifest is not None:
+            name = os.path.basename(filename)
+            manifest.record_published(name, smart.server.base_uri, manifest.hash(name),
+                                      version_id(result.get("etag"), entry.get("resource")))
+    logger.info(f'Published {len(resources)} of {len(files)} artefacts in one transaction')
+    return 201
+
+
+## write_transaction
+#    Write the transaction Bundle of conditional PUTs for (file, resource info) pairs, copying each
+#    file's text in as its entry's resource rather than parsing it
+def write_transaction(fh, resources):
+    fh.write('{"resourceType":"Bundle","type":"transaction","entry":[')
+    for n, (filename, info) in enumerate(resources):
+        request = {"method": "PUT", "url": f'{info["resourceType"]}?url={quote(info["url"], safe=":/")}'}
+        fh.write(('{' if n == 0 else ',{') + '"resource":')
+        with open(filename) as f:
+            shutil.copyfileobj(f, fh)
+        fh.write(',"request":' + json.dumps(request, separators=(',', ':')) + '}')
+    fh.write(']}')
+
+
+## concept_map_header
+#    The ConceptMap resource without its map elements, as a dict in fhirclient's key order
+def concept_map_header(meta):
     cm = conceptmap.ConceptMap()
     cm.id = meta.get('id')
     cm.status = meta.get('status')
@@ -232,105 +439,54 @@ def build_concept_map(rrsfile,outdir,smart,templates_path):
     cm.group = [ conceptmap.ConceptMapGroup() ]
     cm.group[0].source = "http://snomed.info/sct"
     cm.group[0].target = "http://snomed.info/sct"
+    # a placeholder element keeps the position of "element" within the group, it's replaced by the caller
+    cm.group[0].element = [ conceptmap.ConceptMapGroupElement() ]
+    return cm.as_json()
 
-    # add map elements
-    #    0 : Service (Full code), 1: Procedure, 2: Site , 3: Laterality, 4: Contrast (yes/no)
-    elements=[]
-    for index, row in df.iterrows():
-        if not is_numeric(row['Service']):
-            continue
-        element = conceptmap.ConceptMapGroupElement()
-        element.code = row['Procedure']
-        element.target = [conceptmap.ConceptMapGroupElementTarget()]
-        element.target[0].code = row['Service']
-        element.target[0].equivalence = "equivalent"
-        # Check if the subsequent fields contain digits
-        idx = 0
-        if is_numeric(row['Site']):
-            dep = conceptmap.ConceptMapGroupElementTargetDependsOn()
-            dep.property =  prop_site
-            dep.system = "http://snomed.info/sct"
-            ## Body structure
-            dep.value = row['Site']
-            if not isinstance(element.target[0].dependsOn, list):
-                element.target[0].dependsOn = []
-            element.target[0].dependsOn.append(dep)
-        else:
-            dep = conceptmap.ConceptMapGroupElementTargetDependsOn()
-            dep.property = prop_site
-            dep.system = "http://terminology.hl7.org/CodeSystem/data-absent-reason"
-            dep.value = "unknown" 
-            if not isinstance(element.target[0].dependsOn, list):
-               element.target[0].dependsOn = []
-            element.target[0].dependsOn.append(dep)
-        if is_numeric(row['Laterality']):
-            dep = conceptmap.ConceptMapGroupElementTargetDependsOn()
-            dep.property = prop_laterality
-            dep.system = "http://snomed.info/sct"
-            dep.value = row['Laterality']
-            if not isinstance(element.target[0].dependsOn, list):
-                element.target[0].dependsOn = []
-            element.target[0].dependsOn.append(dep)
-        else:
-            dep = conceptmap.ConceptMapGroupElementTargetDependsOn()
-            dep.property = prop_laterality
-            dep.system = "http://terminology.hl7.org/CodeSystem/data-absent-reason"
-            dep.value = "unknown" 
-            if not isinstance(element.target[0].dependsOn, list):
-               element.target[0].dependsOn = []
-            element.target[0].dependsOn.append(dep)    
-        if is_numeric(row['Contrast']):
-            dep = conceptmap.ConceptMapGroupElementTargetDependsOn()
-            dep.property = prop_contrast
-            dep.system = "http://snomed.info/sct"
-            dep.value = row['Contrast']
-            if not isinstance(element.target[0].dependsOn, list):
-                element.target[0].dependsOn = []
-            element.target[0].dependsOn.append(dep)
-        else:
-            dep = conceptmap.ConceptMapGroupElementTargetDependsOn()
-            dep.property = prop_contrast 
-            dep.system = "http://terminology.hl7.org/CodeSystem/data-absent-reason"
-            dep.value = "unknown" 
-            if not isinstance(element.target[0].dependsOn, list):
-               element.target[0].dependsOn = []
-            element.target[0].dependsOn.append(dep)
-        elements.append(element)
-    cm.group[0].element = elements
-    # Dump the ConceptMap to file for manual review
-    with open(mapfile, "w") as f:
-        json.dump(cm.as_json(), f, indent=2)
-    # Cleanup
-    df.drop(df.index, inplace=True)
-    if smart != None:
-        if cm.id:
-            response = cm.update(smart.server)
-        else:
-            response = cm.create(smart.server)
-        if response:
-            return 201
-        else:
-            return 500
-    else:
-        return 200
 
+## depends_on
+#    A dependsOn entry for one qualifier, data-absent-reason unknown if the value is empty
+def depends_on(prop, value):
+    if is_numeric(value):
+        return {"property": prop, "system": "http://snomed.info/sct", "value": value}
+    return {"property": prop, "system": "http://terminology.hl7.org/CodeSystem/data-absent-reason", "value": "unknown"}
 
 
-def build_codesystem_supplement(rrsfile,outdir,smart,templates_path):
+## concept_map_element
+#    The ConceptMap group element for one RRS row, keys in the order fhirclient emits them
+def concept_map_element(row):
+    return {
+        "code": row.Procedure,
+        "target": [{
+            "code": row.Service,
+            "dependsOn": [
+                depends_on("BodySite", row.Site),
+                depends_on("Laterality", row.Laterality),
+                depends_on("Contrast", row.Contrast)
+            ],
+            "equivalence": "equivalent"
+        }]
+    }
+
+
+
+def build_codesystem_supplement(rrs,outdir,smart,templates_path,compact=False,manifest=None):
     """
     Build a SNOMED CT codesystem supplement of procedures, bodysite, laterality and 
     contrast for each single radiology service code 
     """
     print(f'...Building CodeSystem Supplement')
     cs_sup_file = os.path.join(outdir,"CodeSystemSupplementRadiology.json")
-    df=pd.read_csv(rrsfile,sep='\t',dtype={'Service':str,'Procedure':str,'Site':str,'Laterality':str,'Contrast':str})
+    table=as_rrs_table(rrs)
     
     # Read the FHIR ConceptMap JSON file into a Python dictionary
     template =  os.path.join('.',templates_path,'CodeSystemSupplement-template.json')
     print("Processing CodeSystem Supplement template...{0}".format(template))
     
     ## Drop any duplicate rows
-    df.drop_duplicates(subset=['Service', 'Procedure'], inplace=True)
+    unique_rows = {}
+    for row in table:
+        unique_rows.setdefault((row.Service, row.Procedure), row)
 
     def make_property(source):
         prop = codesystem.CodeSystemProperty()
@@ -357,70 +513,110 @@ def build_codesystem_supplement(rrsfile,outdir,smart,templates_path):
         cs.property = [ make_property(x) for x in meta["property"] ]
         cs.concept = []        
        
-        for index, row in df.iterrows():
-            if not is_numeric(row['Service']):
+        for row in unique_rows.values():
+            if not is_numeric(row.Service):
                 continue
             concept = codesystem.CodeSystemConcept()
-            concept.code = row['Service']        
+            concept.code = row.Service        
             concept.property = [] 
-            if is_numeric(row['Procedure']):
+            if is_numeric(row.Procedure):
                 prop = codesystem.CodeSystemConceptProperty()
                 prop.code = "Procedure"
-                prop.valueCode = row['Procedure']
+                prop.valueCode = row.Procedure
                 concept.property.append(prop)
-            if is_numeric(row['Site']): 
+            if is_numeric(row.Site): 
                 prop = codesystem.CodeSystemConceptProperty()
                 prop.code = "BodySite"
-                prop.valueCode = row['Site']
+                prop.valueCode = row.Site
                 concept.property.append(prop)
-            if is_numeric(row['Laterality']): 
+            if is_numeric(row.Laterality): 
                 prop = codesystem.CodeSystemConceptProperty()
                 prop.code = "BodySiteLaterality"
-                prop.valueCode = row['Laterality']
+                prop.valueCode = row.Laterality
                 concept.property.append(prop)
-            if is_numeric(row['Contrast']): 
+            if is_numeric(row.Contrast): 
                 prop = codesystem.CodeSystemConceptProperty()
                 prop.code = "Contrast"
-                prop.valueCode = row['Contrast']
+                prop.valueCode = row.Contrast
                 concept.property.append(prop)
             cs.concept.append(concept)
         # Dump the ConceptMap to file for manual review
-        with open(cs_sup_file, "w") as f:
-            json.dump(cs.as_json(), f, indent=2)
+        write_resource(cs_sup_file, cs.as_json(), compact, manifest)
     
         if smart != None:
-            if cs.id:
-                response = cs.update(smart.server)
-            else:
-                response = cs.create(smart.server)
-            if response:
-                return 201
-            else:
-                return 500
+            return publish_file(smart, "CodeSystem", cs.id, cs_sup_file, manifest)
         else:
             return 200
 
 ## Mainline
 ## Output the Valuesets and Conceptmap built from the RRS file    
-def run_main(rrsfile,outdir,endpoint,templates_path):
+##   transaction publishes them together in one transaction Bundle once they are all built
+##   check_server asks the server whether its copy of an unchanged artefact changed before skipping it
+##   validate checks the artefacts locally and with the server's $validate, concurrently, and a transaction
+##   isn't published if any of them is invalid
+##   return the artefact files
+def run_main(rrsfile,outdir,endpoint,templates_path,compact=False,transaction=False,check_server=False,validate=False):
     smart=None
     if (endpoint != ""):
          smart = create_client(endpoint)
+    # Each builder publishes as it goes unless the artefacts are published together
+    publish = None if transaction else smart
+    # Content hashes of what the last build wrote and published, unchanged artefacts aren't rewritten or republished
+    manifest = ArtefactManifest(os.path.join(outdir,"artefacts.manifest.json"),check_server)
     
     # Note, the template file order must match the valueset file order
     vs_files=create_vs_filepath(outdir)
     logger.info(f'getting template files from {templates_path}')
     templates=get_template_files(templates_path)
+    # Parse rrs.txt once for all the builders
+    with metrics.stage("lighter.load"):
+        table=load_rrs(rrsfile)
+    metrics.get_metrics().gauge("lighter.rows",len(table))
+    artefacts=[]
 
-    for col in range(0,5):
-        vs = build_valueset(col,templates[col],rrsfile,vs_files[col],smart)
-        msg = f'{col} Processed valueset template...{templates[col]}, returned {vs}'
+    try:
+        for col in range(0,5):
+            with metrics.stage("lighter.valuesets"):
+                vs = build_valueset(col,templates[col],table,vs_files[col],publish,compact,manifest)
+            artefacts.append(vs_files[col])
+            msg = f'{col} Processed valueset template...{templates[col]}, returned {vs}'
+            logger.info(msg)
+            print(msg)
+
+        with metrics.stage("lighter.conceptmap"):
+            cm = build_concept_map(table,outdir,publish,templates_path,compact,manifest)
+        artefacts.append(os.path.join(outdir,"ConceptMap_RadiologyServices.json"))
+        logger.info(f'Processed ConceptMap template. Returned {cm}')      
+        #csupp = build_codesystem_supplement(table,outdir,publish,templates_path,compact,manifest)    
+        #artefacts.append(os.path.join(outdir,"CodeSystemSupplementRadiology.json"))
+        #logger.info(f'Built CodeSystem Supplement, returned {csupp}')
+        # Create custom per modality ValueSets
+        with metrics.stage("lighter.bodysite"):
+            artefacts.extend(build_bodysite_valuesets(table,outdir,publish,templates_path,compact,manifest))
+        valid = True
+        if validate:
+            with metrics.stage("lighter.validate"):
+                valid = validate_artefacts(artefacts,endpoint)
+        if transaction and smart != None and not valid:
+            logger.error('Not publishing the transaction, some artefacts are invalid')
+        elif transaction and smart != None:
+            with metrics.stage("lighter.publish"):
+                status = publish_transaction(smart,artefacts,outdir,manifest)
+            logger.info(f'Published {len(artefacts)} artefacts in one transaction, returned {status}')
+    finally:
+        manifest.save()
+    return artefacts
+
+
+## validate_artefacts
+## Validate the artefact files and log the issues found
+##   return True if they are all valid
+def validate_artefacts(files,endpoint):
+    results = validate_files(files,endpoint)
+    for filename, (valid, issues) in results.items():
+        for i in issues:
+            logger.info(f'{os.path.basename(filename)} {i.get("severity")} {i.get("code")}: {i.get("diagnostics")}')
+        msg = f'Validated {os.path.basename(filename)}: {"valid" if valid else "INVALID"}'
         logger.info(msg)
         print(msg)
-
-    cm = build_concept_map(rrsfile,outdir,smart,templates_path)
-    logger.info(f'Processed ConceptMap template. Returned {cm}')      
-    #csupp = build_codesystem_supplement(rrsfile,outdir,smart,templates_path)    
-    #logger.info(f'Built CodeSystem Supplement, returned {csupp}')
-    # Create custom per modality ValueSets
-    build_bodysite_valuesets(rrsfile,outdir,smart,templates_path)
+    return all(valid for valid, issues in results.values())
@@ -1,9 +1,9 @@
 import argparse
 import os
-import fetcher
-import lighter
 import logging
 from datetime import datetime
+# fetcher, lighter and the libraries they pull in (pandas, fhirpathpy, fhirclient, requests) are
+# imported in main() once the arguments are parsed, only by the stages that run, see TestStartup
 
 def main():
     homedir=os.environ['HOME']
@@ -18,18 +18,78 @@ def main():
     parser.add_argument("-p", "--publish", help="publish to this fhir endpoint", default=endpoint_default)
     parser.add_argument("-t", "--templates", help="templates path relative to this source folder", default=templates_path)
     parser.add_argument("-s", "--skip", help="Skip generating the rrs.txt file", default="")
+    parser.add_argument("-c", "--cache", help="terminology response cache file, empty to disable", default=os.path.join(homedir,"data","rrs","cache","terminology.sqlite"))
+    parser.add_argument("--cache-ttl", help="cache entry lifetime in hours", type=float, default=168)
+    parser.add_argument("--cache-size", help="maximum cache size in MB", type=int, default=512)
+    parser.add_argument("-w", "--workers", help="number of concurrent terminology server requests", type=int, default=1)
+    parser.add_argument("-r", "--resume", help="resume an interrupted build from the rrs.journal in the output dir", action="store_true")
+    parser.add_argument("-d", "--delta", help="only build target codes that are new since the last build in the output dir", action="store_true")
+    parser.add_argument("--terminology", help="terminology server base url, or local:/path/to/rf2 to use an RF2 snapshot", default="")
+    parser.add_argument("--timeout", help="terminology server read timeout in seconds", type=float, default=300)
+    parser.add_argument("--retries", help="retries for failed or throttled terminology server requests", type=int, default=5)
+    parser.add_argument("--rate", help="maximum terminology server requests per second, 0 for no limit", type=float, default=0)
+    parser.add_argument("-b", "--batch-size", help="codes per batch $lookup Bundle, 0 to look up one code at a time", type=int, default=100)
+    parser.add_argument("--compact", help="write the FHIR artefacts without indentation", action="store_true")
+    parser.add_argument("--transaction", help="publish all the artefacts together in one transaction Bundle", action="store_true")
+    parser.add_argument("--check-server", help="check the server copy of unchanged artefacts with If-None-Match before skipping them", action="store_true")
+    parser.add_argument("--validate", help="validate the artefacts, locally and with the publish endpoint's $validate", action="store_true")
+    parser.add_argument("--profile", help="sample the run with a profiler and write profile.folded to the output dir", action="store_true")
+    parser.add_argument("--shard", help="build only shard i of N (0 <= i < N) of the target codes into rrs.part-i-of-N.txt, e.g. 2/8", default="")
+    parser.add_argument("--merge", help="merge the N shard partial files into rrs.txt, then build the artefacts", type=int, default=0)
+    parser.add_argument("--processes", help="build the shards in this many processes and merge them", type=int, default=1)
 
     args = parser.parse_args()
+    if args.shard != "":
+        try:
+            index, count = [int(n) for n in args.shard.split('/')]
+        except ValueError:
+            parser.error(f'--shard must be i/N, not {args.shard}')
+        if not 0 <= index < count:
+            parser.error(f'--shard {args.shard}: the shard index must be from 0 to {count-1}')
     now = datetime.now() # current date and time
     ts = now.strftime("%Y%m%d-%H%M%S")
     FORMAT='%(asctime)s %(lineno)d : %(message)s'
-    logging.basicConfig(format=FORMAT, filename=f'build-rrs-{ts}.log',level=logging.INFO)
+    # sharded builds' worker processes log to the same file
+    log_settings = dict(format=FORMAT, filename=f'build-rrs-{ts}.log',level=logging.INFO)
+    logging.basicConfig(**log_settings)
     logger.info('Started')
-    if args.skip != "yes":
-        rrsfile=fetcher.run_main(args.infile,args.outdir)
-    else:
-        rrsfile=os.path.join(args.outdir,'rrs.txt')
-    lighter.run_main(rrsfile,args.outdir,args.publish,args.templates)
+    import termclient
+    import metrics
+    # the rate limit is shared between the processes of a sharded build
+    client_settings = dict(timeout=(10,args.timeout),retries=args.retries,rate=args.rate/max(args.processes,1),pool_size=max(16,args.workers))
+    termclient.configure(**client_settings)
+    profiler = metrics.Profiler().start() if args.profile else None
+    try:
+        if args.skip != "yes":
+            import fetcher
+            fetcher.set_terminology(args.terminology)
+            with metrics.stage("fetcher"):
+                build = dict(cachefile=args.cache,cache_ttl=args.cache_ttl*3600,cache_size=args.cache_size*1024*1024,workers=args.workers,
+                             batch_size=args.batch_size,resume=args.resume,delta=args.delta)
+                if args.merge > 0:
+                    rrsfile=fetcher.merge_shards(args.infile,args.outdir,args.merge)
+                elif args.shard != "":
+                    # one shard of a build spread over several machines, --merge builds rrs.txt once they are all done
+                    partfile=fetcher.run_main(args.infile,args.outdir,shard=(index,count),**build)
+                    logger.info(f'Built shard {partfile}')
+                    return
+                elif args.processes > 1:
+                    rrsfile=fetcher.run_sharded(args.infile,args.outdir,args.processes,args.terminology,client_settings,log_settings,**build)
+                else:
+                    rrsfile=fetcher.run_main(args.infile,args.outdir,**build)
+        else:
+            rrsfile=os.path.join(args.outdir,'rrs.txt')
+        import lighter
+        with metrics.stage("lighter"):
+            lighter.run_main(rrsfile,args.outdir,args.publish,args.templates,args.compact,args.transaction,args.check_server,args.validate)
+    finally:
+        if profiler != None:
+            profiler.stop()
+        # Timings, request latencies and hit rates for the run, next to the artefacts
+        if os.path.isdir(args.outdir):
+            metrics.get_metrics().write(os.path.join(args.outdir,"metrics.json"))
+            if profiler != None:
+                profiler.write(os.path.join(args.outdir,"profile.folded"))
     logger.info("Finished")
 
 if __name__ == '__main__':
@@ -0,0 +1,160 @@
+"""
+   build metrics
+   Wall and CPU time per stage, counters and gauges for a run, written with the terminology client's
+   per-endpoint request latencies as metrics.json next to the artefacts, and a sampling profiler that
+   writes collapsed stacks for flame graph tools
+"""
+
+import json
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from termclient import get_client
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    """
+    Stage timers, counters and gauges.  A stage may run many times, e.g. once per row, and on
+    several threads; its count, wall and CPU time are totals.  CPU time is the whole process's for
+    a stage on the main thread and the thread's own for a stage on a worker thread.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        clock = time.process_time if threading.current_thread() is threading.main_thread() else time.thread_time
+        wall = time.perf_counter()
+        cpu = clock()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = clock() - cpu
+            with self._lock:
+                stats = self.stages.setdefault(name, {"count": 0, "wall": 0.0, "cpu": 0.0})
+                stats["count"] += 1
+                stats["wall"] += wall
+                stats["cpu"] += cpu
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    ## merge
+    ## Add the stages and counters of another run's snapshot, e.g. a worker process's, to these.
+    ## Its gauges are kept under prefix; its request latencies are merged into the client separately.
+    def merge(self, snapshot, prefix=""):
+        with self._lock:
+            for name, s in snapshot.get("stages", {}).items():
+                stats = self.stages.setdefault(name, {"count": 0, "wall": 0.0, "cpu": 0.0})
+                stats["count"] += s["count"]
+                stats["wall"] += s["wall"]
+                stats["cpu"] += s["cpu"]
+            for name, n in snapshot.get("counters", {}).items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, value in snapshot.get("gauges", {}).items():
+                self.gauges[prefix + name] = value
+
+    ## snapshot
+    ##   return the metrics, with the terminology client's latencies, as a dict
+    def snapshot(self):
+        with self._lock:
+            stages = {name: {"count": s["count"], "wall": round(s["wall"], 4), "cpu": round(s["cpu"], 4)}
+                      for name, s in self.stages.items()}
+            return {
+                "elapsed": round(time.perf_counter() - self.started, 4),
+                "stages": stages,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "http": get_client().stats()
+            }
+
+    def write(self, filename):
+        with open(filename, "w") as fh:
+            json.dump(self.snapshot(), fh, indent=2)
+        logger.info(f'Wrote metrics {filename}')
+
+
+_metrics = Metrics()
+
+
+## get_metrics
+##   return the metrics for this run
+def get_metrics():
+    return _metrics
+
+
+## reset
+##   start a new set of metrics
+def reset():
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+
+## stage
+## Time a stage of the run, e.g. with metrics.stage("lighter.conceptmap"):
+def stage(name):
+    return _metrics.stage(name)
+
+
+class Profiler:
+    """
+    Sampling profiler: a background thread records every other thread's Python stack each interval
+    seconds.  write() saves them as collapsed stacks, "outer;inner count" per line.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, filename):
+        with open(filename, "w") as fh:
+            for stack, n in self.samples.most_common():
+                fh.write(f'{stack} {n}\n')
+        logger.info(f'Wrote {sum(self.samples.values())} profile samples to {filename}')
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,368 @@
+"""
+   local SNOMED CT engine
+   Loads an RF2 snapshot into array backed adjacency structures and answers the ValueSet $expand
+   and CodeSystem $lookup queries fetcher.py makes, so a build can run with no terminology server
+"""
+
+import csv
+import glob
+import logging
+import os
+import re
+from urllib.parse import unquote
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+system = "http://snomed.info/sct"
+ecl_prefix = system + "?fhir_vs=ecl/"
+IS_A = 116680003
+PRIMITIVE = 900000000000074008
+FSN = 900000000000003001
+
+
+## find_rf2_file
+##   return the snapshot file in path matching the RF2 file name prefix, or None
+def find_rf2_file(path, prefix):
+    matches = sorted(glob.glob(os.path.join(path, '**', prefix + '*.txt'), recursive=True))
+    return matches[0] if matches else None
+
+
+def read_rf2(filename, columns, dtypes):
+    df = pd.read_csv(filename, sep='\t', usecols=columns, dtype=dtypes,
+                     quoting=csv.QUOTE_NONE, keep_default_na=False)
+    return df[df['active'] == 1]
+
+
+class Csr:
+    """
+    Compressed sparse row adjacency: the neighbours of node i are
+    targets[offsets[i]:offsets[i+1]]
+    """
+
+    def __init__(self, size, sources, targets, *columns):
+        order = np.argsort(sources, kind='stable')
+        self.offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=size), out=self.offsets[1:])
+        self.targets = targets[order]
+        self.columns = [c[order] for c in columns]
+
+    def __getitem__(self, i):
+        return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+    def row(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return [self.targets[start:end]] + [c[start:end] for c in self.columns]
+
+
+class Rf2Snapshot:
+    """
+    In memory SNOMED CT snapshot.  Concepts are held as a sorted int64 array of ids and
+    referred to internally by their position in it; the IS-A hierarchy, attribute
+    relationships and descriptions are CSR arrays over those positions.
+    Inferred relationships are used, falling back to stated relationships if the
+    snapshot has no inferred file.
+    """
+
+    def __init__(self, path):
+        concept_file = find_rf2_file(path, 'sct2_Concept_Snapshot')
+        if concept_file is None:
+            raise FileNotFoundError(f'No RF2 concept snapshot found under {path}')
+        relationship_file = (find_rf2_file(path, 'sct2_Relationship_Snapshot')
+                             or find_rf2_file(path, 'sct2_StatedRelationship_Snapshot'))
+        description_file = find_rf2_file(path, 'sct2_Description_Snapshot')
+        logger.info(f'Loading RF2 snapshot from {path}')
+
+        concepts = read_rf2(concept_file, ['id', 'active', 'definitionStatusId'],
+                            {'id': np.int64, 'active': np.int8, 'definitionStatusId': np.int64})
+        concepts = concepts.sort_values('id')
+        self.ids = concepts['id'].to_numpy()
+        self.primitive = concepts['definitionStatusId'].to_numpy() == PRIMITIVE
+        size = len(self.ids)
+        release = re.search(r'_(\d{8})\.txt$', concept_file)
+        self.version = f'{system}/version/{release.group(1)}' if release else 'local'
+
+        rels = read_rf2(relationship_file,
+                        ['active', 'sourceId', 'destinationId', 'relationshipGroup', 'typeId'],
+                        {'active': np.int8, 'sourceId': np.int64, 'destinationId': np.int64,
+                         'relationshipGroup': np.int64, 'typeId': np.int64})
+        src = self.index_of(rels['sourceId'].to_numpy())
+        dst = self.index_of(rels['destinationId'].to_numpy())
+        known = (src >= 0) & (dst >= 0)
+        isa = known & (rels['typeId'].to_numpy() == IS_A)
+        self.parents = Csr(size, src[isa], dst[isa])
+        self.children = Csr(size, dst[isa], src[isa])
+        attr = known & ~isa
+        # attribute triples, also kept flat for vectorised refinement queries
+        self.attr_src = src[attr]
+        self.attr_type = rels['typeId'].to_numpy()[attr]
+        self.attr_dst = dst[attr]
+        self.attributes = Csr(size, self.attr_src, self.attr_dst,
+                              self.attr_type, rels['relationshipGroup'].to_numpy()[attr])
+
+        if description_file:
+            desc = read_rf2(description_file, ['active', 'conceptId', 'typeId', 'term'],
+                            {'active': np.int8, 'conceptId': np.int64, 'typeId': np.int64, 'term': str})
+            cid = self.index_of(desc['conceptId'].to_numpy())
+            keep = cid >= 0
+            self.descriptions = Csr(size, cid[keep], desc['term'].to_numpy(dtype=object)[keep],
+                                    desc['typeId'].to_numpy()[keep] == FSN)
+        else:
+            self.descriptions = Csr(size, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=object),
+                                    np.zeros(0, dtype=bool))
+        logger.info(f'Loaded {size} concepts, {len(self.attr_src)} attributes, version {self.version}')
+
+    ## index_of
+    ##   return the internal positions of an array of concept ids, -1 where the id is unknown
+    def index_of(self, codes):
+        codes = np.asarray(codes, dtype=np.int64)
+        pos = np.searchsorted(self.ids, codes)
+        pos[pos >= len(self.ids)] = 0
+        return np.where(self.ids[pos] == codes, pos, -1)
+
+    def index(self, code):
+        try:
+            pos = self.index_of([int(code)])[0]
+        except ValueError:
+            return -1
+        return int(pos)
+
+    def code(self, i):
+        return str(self.ids[i])
+
+    def _closure(self, start, adjacency):
+        seen = set()
+        stack = adjacency[start].tolist()
+        while stack:
+            i = stack.pop()
+            if i in seen:
+                continue
+            seen.add(i)
+            stack.extend(adjacency[i].tolist())
+        return seen
+
+    def ancestors(self, i):
+        return self._closure(i, self.parents)
+
+    def descendants(self, i):
+        return self._closure(i, self.children)
+
+    ## refine
+    ##   return the concepts with an attribute of type type_id whose value is in values
+    def refine(self, type_id, values):
+        mask = np.isin(self.attr_dst, np.fromiter(values, dtype=np.int64, count=len(values)))
+        if type_id is not None:
+            mask &= self.attr_type == type_id
+        return set(self.attr_src[mask].tolist())
+
+    ## term_match
+    ##   ECL term filter match, every word of the search term is a prefix of a word in a description
+    def term_match(self, i, words):
+        for term in self.descriptions[i]:
+            term_words = term.lower().split()
+            if all(any(w.startswith(s) for w in term_words) for s in words):
+                return True
+        return False
+
+    def display(self, i):
+        terms, fsn = self.descriptions.row(i)
+        for term, is_fsn in zip(terms, fsn):
+            if is_fsn:
+                return term
+        return terms[0] if len(terms) else ''
+
+    ## evaluate
+    ##   return the set of concept positions matching an ECL expression
+    def evaluate(self, ecl):
+        return EclParser(self, ecl).parse()
+
+    ## expand
+    ## Answer a ValueSet $expand of an implicit ECL ValueSet url
+    ##   return a FHIR ValueSet with the expansion, codes in ascending order
+    def expand(self, url, offset=0, count=None):
+        if not url.startswith(ecl_prefix):
+            raise ValueError(f'Only implicit ECL ValueSets are supported locally: {url}')
+        codes = sorted(self.ids[i] for i in self.evaluate(unquote(url[len(ecl_prefix):])))
+        total = len(codes)
+        page = codes[offset:offset + count] if count is not None else codes[offset:]
+        return {
+            "resourceType": "ValueSet",
+            "status": "active",
+            "expansion": {
+                "total": total,
+                "offset": offset,
+                "contains": [{"system": system, "code": str(code)} for code in page]
+            }
+        }
+
+    ## lookup
+    ## Answer a CodeSystem $lookup with property=*, attributes in role groups are returned as
+    ## subproperties of a 609096000 (Role group) property, the same shape Ontoserver returns
+    ##   return a FHIR Parameters resource, or an OperationOutcome if the code is unknown
+    def lookup(self, code):
+        i = self.index(code)
+        if i < 0:
+            return {
+                "resourceType": "OperationOutcome",
+                "issue": [{"severity": "error", "code": "not-found",
+                           "diagnostics": f'Unable to find code {code} in {system}'}]
+            }
+        parameters = [
+            {"name": "name", "valueString": "SNOMED CT"},
+            {"name": "version", "valueString": self.version},
+            {"name": "display", "valueString": self.display(i)},
+            {"name": "property", "part": [{"name": "code", "valueCode": "sufficientlyDefined"},
+                                          {"name": "value", "valueBoolean": not bool(self.primitive[i])}]}
+        ]
+        for parent in self.parents[i]:
+            parameters.append({"name": "property", "part": [{"name": "code", "valueCode": "parent"},
+                                                            {"name": "value", "valueCode": self.code(parent)}]})
+        targets, types, groups = self.attributes.row(i)
+        grouped = {}
+        for dst, type_id, group in zip(targets, types, groups):
+            part = [{"name": "code", "valueCode": str(type_id)}, {"name": "value", "valueCode": self.code(dst)}]
+            if group == 0:
+                parameters.append({"name": "property", "part": part})
+            else:
+                grouped.setdefault(int(group), []).append(part)
+        for group in sorted(grouped):
+            parts = [{"name": "code", "valueCode": "609096000"}]
+            parts.extend({"name": "subproperty", "part": part} for part in grouped[group])
+            parameters.append({"name": "property", "part": parts})
+        return {"resourceType": "Parameters", "parameter": parameters}
+
+
+class EclParser:
+    """
+    Recursive descent parser and evaluator for the subset of ECL fetcher.py uses:
+    constraint operators (< << > >> <! >!), wildcard, nested expressions,
+    attribute refinements (= and !=), AND / OR / MINUS, and term and
+    definitionStatus filters.
+    """
+
+    token_re = re.compile(r'\s*(<<|>>|<!|>!|!=|\{\{|\}\}|[<>=:,()*]|"[^"]*"|\|[^|]*\||[A-Za-z]+|\d+)')
+
+    def __init__(self, snapshot, ecl):
+        self.snapshot = snapshot
+        self.tokens = []
+        pos = 0
+        ecl = ecl.strip()
+        while pos < len(ecl):
+            match = self.token_re.match(ecl, pos)
+            if not match:
+                raise ValueError(f'Unsupported ECL at {pos}: {ecl}')
+            # terms between pipes are descriptive only
+            if not match.group(1).startswith('|'):
+                self.tokens.append(match.group(1))
+            pos = match.end()
+            while pos < len(ecl) and ecl[pos].isspace():
+                pos += 1
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token.upper() != expected.upper()):
+            raise ValueError(f'Expected {expected} but found {token} in ECL')
+        self.pos += 1
+        return token
+
+    def parse(self):
+        result = self.expression()
+        if self.peek() is not None:
+            raise ValueError(f'Unexpected {self.peek()} in ECL')
+        return result
+
+    def expression(self):
+        result = self.refined()
+        while self.peek() is not None and self.peek().upper() in ('AND', 'OR', 'MINUS'):
+            op = self.take().upper()
+            other = self.refined()
+            if op == 'AND':
+                result = result & other
+            elif op == 'OR':
+                result = result | other
+            else:
+                result = result - other
+        return result
+
+    def refined(self):
+        result = self.subexpression()
+        if self.peek() == ':':
+            self.take(':')
+            result = result & self.attribute()
+            while self.peek() == ',' or (self.peek() or '').upper() == 'AND':
+                self.take()
+                result = result & self.attribute()
+        return self.filters(result)
+
+    def subexpression(self):
+        op = self.peek() if self.peek() in ('<', '<<', '>', '>>', '<!', '>!') else None
+        if op:
+            self.take()
+        focus = self.focus()
+        if op is None:
+            return focus
+        snapshot = self.snapshot
+        result = set()
+        for i in focus:
+            if op == '<':
+                result |= snapshot.descendants(i)
+            elif op == '<<':
+                result |= snapshot.descendants(i) | {i}
+            elif op == '>':
+                result |= snapshot.ancestors(i)
+            elif op == '>>':
+                result |= snapshot.ancestors(i) | {i}
+            elif op == '<!':
+                result.update(snapshot.children[i].tolist())
+            else:
+                result.update(snapshot.parents[i].tolist())
+        return self.filters(result)
+
+    def focus(self):
+        token = self.take()
+        if token == '*':
+            return set(range(len(self.snapshot.ids)))
+        if token == '(':
+            result = self.expression()
+            self.take(')')
+            return result
+        if token.isdigit():
+            i = self.snapshot.index(token)
+            return {i} if i >= 0 else set()
+        raise ValueError(f'Unexpected {token} in ECL')
+
+    def attribute(self):
+        token = self.take()
+        type_id = None if token == '*' else int(token)
+        comparison = self.take()
+        if comparison not in ('=', '!='):
+            raise ValueError(f'Unsupported attribute comparison {comparison} in ECL')
+        values = self.subexpression()
+        if comparison == '!=':
+            values = set(range(len(self.snapshot.ids))) - values
+        return self.snapshot.refine(type_id, values)
+
+    def filters(self, result):
+        while self.peek() == '{{':
+            self.take('{{')
+            field = self.take()
+            if field.upper() == 'C':
+                field = self.take()
+            self.take('=')
+            value = self.take()
+            self.take('}}')
+            if field == 'term':
+                words = value.strip('"').lower().split()
+                result = {i for i in result if self.snapshot.term_match(i, words)}
+            elif field == 'definitionStatus':
+                primitive = value.strip('"').lower() == 'primitive'
+                result = {i for i in result if bool(self.snapshot.primitive[i]) == primitive}
+            else:
+                raise ValueError(f'Unsupported ECL filter {field}')
+        return result
@@ -0,0 +1,240 @@
+"""
+   stand-in FHIR terminology server
+   A small local FHIR server for tests and benchmarks.  $expand and $lookup are answered from an
+   RF2 snapshot (by default the fixture in test_data/rf2), resources PUT or POSTed are kept in memory,
+   batch and transaction Bundles and conditional PUTs by canonical url are supported, and every
+   request can be delayed to mimic a remote server.
+
+   python stubserver.py --port 8080 --latency 50
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from rf2 import Rf2Snapshot
+
+logger = logging.getLogger(__name__)
+
+default_rf2 = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'rf2')
+base_path = '/fhir'
+
+
+def operation_outcome(severity, code, diagnostics):
+    return {
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": severity, "code": code, "diagnostics": diagnostics}]
+    }
+
+
+class StubStore:
+    """
+    The terminology snapshot plus the resources written to the server, keyed by type and id
+    """
+
+    def __init__(self, snapshot, latency=0.0):
+        self.snapshot = snapshot
+        self.latency = latency
+        self.resources = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._transaction_lock = threading.Lock()
+
+    ## count_request
+    ## Count an HTTP request, requests is the number of round trips, a Bundle's entries aren't counted
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    ## handle
+    ## Process one FHIR request
+    ##   return (status, resource, headers)
+    def handle(self, method, path, query, body, headers=None):
+        parts = [p for p in path.split('/') if p]
+        if method == 'GET' and parts == ['metadata']:
+            return 200, {"resourceType": "CapabilityStatement", "status": "active", "kind": "instance",
+                         "fhirVersion": "4.0.1", "format": ["json"]}, {}
+        if method == 'GET' and parts == ['ValueSet', '$expand']:
+            return self.expand(query)
+        if method == 'GET' and parts == ['CodeSystem', '$lookup']:
+            return self.lookup(query)
+        if method == 'POST' and not parts:
+            return self.bundle(body)
+        if method == 'POST' and len(parts) == 2 and parts[1] == '$validate':
+            return self.validate(parts[0], body)
+        if method == 'POST' and len(parts) == 1:
+            return self.write(parts[0], str(uuid.uuid4()), body, created=True)
+        if method == 'PUT' and len(parts) == 1 and 'url' in query:
+            return self.conditional_write(parts[0], query['url'][0], body)
+        if method == 'PUT' and len(parts) == 2:
+            return self.write(parts[0], parts[1], body)
+        if method == 'GET' and len(parts) == 2:
+            return self.read(parts[0], parts[1], (headers or {}).get('If-None-Match'))
+        return 404, operation_outcome("error", "not-supported", f'{method} {path} is not supported'), {}
+
+    def expand(self, query):
+        url = query.get('url', [''])[0]
+        offset = int(query.get('offset', ['0'])[0])
+        count = int(query['count'][0]) if 'count' in query else None
+        try:
+            return 200, self.snapshot.expand(url, offset=offset, count=count), {}
+        except ValueError as e:
+            return 400, operation_outcome("error", "invalid", str(e)), {}
+
+    def lookup(self, query):
+        data = self.snapshot.lookup(query.get('code', [''])[0])
+        return (200 if data["resourceType"] == "Parameters" else 404), data, {}
+
+    def validate(self, resource_type, body):
+        if not isinstance(body, dict) or body.get("resourceType") != resource_type:
+            return 400, operation_outcome("error", "invalid", f'Expected a {resource_type} resource'), {}
+        return 200, operation_outcome("information", "informational", "Validation successful"), {}
+
+    def write(self, resource_type, id, body, created=False):
+        if not isinstance(body, dict) or body.get("resourceType") != resource_type:
+            return 400, operation_outcome("error", "invalid", f'Expected a {resource_type} resource'), {}
+        with self._lock:
+            previous = self.resources.get((resource_type, id))
+            version = int(previous["meta"]["versionId"]) + 1 if previous else 1
+            resource = dict(body, id=id, meta={"versionId": str(version)})
+            self.resources[(resource_type, id)] = resource
+        status = 201 if created or previous is None else 200
+        return status, resource, {"ETag": f'W/"{version}"', "Location": f'{base_path}/{resource_type}/{id}'}
+
+    ## conditional_write
+    ## PUT Type?url=canonical, update the resource with that canonical url or create it
+    def conditional_write(self, resource_type, url, body):
+        with self._lock:
+            matches = [key[1] for key, resource in self.resources.items()
+                       if key[0] == resource_type and resource.get("url") == url]
+        if len(matches) > 1:
+            return 412, operation_outcome("error", "multiple-matches", f'{len(matches)} {resource_type} match {url}'), {}
+        id = matches[0] if matches else (body or {}).get("id") or str(uuid.uuid4())
+        return self.write(resource_type, id, body)
+
+    def read(self, resource_type, id, if_none_match=None):
+        resource = self.resources.get((resource_type, id))
+        if resource is None:
+            return 404, operation_outcome("error", "not-found", f'{resource_type}/{id} not found'), {}
+        etag = f'W/"{resource["meta"]["versionId"]}"'
+        if if_none_match == etag:
+            return 304, None, {"ETag": etag}
+        return 200, resource, {"ETag": etag}
+
+    def bundle(self, body):
+        if not isinstance(body, dict) or body.get("resourceType") != "Bundle" \
+                or body.get("type") not in ("batch", "transaction"):
+            return 400, operation_outcome("error", "invalid", "Expected a batch or transaction Bundle"), {}
+        transaction = body["type"] == "transaction"
+        if transaction:
+            # a transaction succeeds or fails as a whole
+            self._transaction_lock.acquire()
+            with self._lock:
+                saved = dict(self.resources)
+        try:
+            entries = []
+            for entry in body.get("entry", []):
+                request = entry.get("request", {})
+                url = urlparse(request.get("url", ""))
+                status, resource, headers = self.handle(request.get("method", "GET"), url.path,
+                                                        parse_qs(url.query), entry.get("resource"))
+                if transaction and status >= 400:
+                    with self._lock:
+                        self.resources = saved
+                    return status, resource, {}
+                response = {"status": str(status)}
+                if "ETag" in headers:
+                    response["etag"] = headers["ETag"]
+                if "Location" in headers:
+                    response["location"] = headers["Location"]
+                entries.append({"resource": resource, "response": response})
+        finally:
+            if transaction:
+                self._transaction_lock.release()
+        return 200, {"resourceType": "Bundle", "type": body["type"] + "-response", "entry": entries}, {}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    store = None
+
+    def _dispatch(self, method):
+        self.store.count_request()
+        if self.store.latency:
+            time.sleep(self.store.latency)
+        url = urlparse(self.path)
+        path = url.path
+        if path.startswith(base_path):
+            path = path[len(base_path):]
+        body = None
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            try:
+                payload = self.rfile.read(length)
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    payload = gzip.decompress(payload)
+                body = json.loads(payload)
+            except (ValueError, OSError, EOFError):
+                body = None
+        status, resource, headers = self.store.handle(method, path, parse_qs(url.query), body, self.headers)
+        payload = json.dumps(resource).encode('utf-8') if resource is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/fhir+json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+## start_server
+## Start a stub server on a background thread, port 0 picks a free port
+##   return the server, its base url is server.base_url
+def start_server(port=0, rf2=default_rf2, latency=0.0):
+    store = StubStore(Rf2Snapshot(rf2), latency)
+    handler = type('BoundStubHandler', (StubHandler,), {'store': store})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    server.store = store
+    server.base_url = 'http://127.0.0.1:{0}{1}'.format(server.server_port, base_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", help="port to listen on", type=int, default=8080)
+    parser.add_argument("--rf2", help="RF2 snapshot folder", default=default_rf2)
+    parser.add_argument("--latency", help="delay added to every request in milliseconds", type=float, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = start_server(args.port, args.rf2, args.latency / 1000)
+    print(f'Stub FHIR server listening on {server.base_url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+   terminology client
+   One pooled HTTP session shared by every call to the terminology and FHIR servers, with
+   timeouts, retry with exponential backoff, a request rate limit and per-endpoint latency
+"""
+
+import logging
+import math
+import random
+import threading
+import time
+from bisect import bisect_right
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+## percentile
+##   return the pth percentile of a sorted list by the nearest-rank method
+def percentile(values, p):
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter, rate tokens per second up to capacity.
+    A rate of 0 turns the limit off.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class TerminologyClient:
+    """
+    Pooled requests session with retry, backoff, rate limiting and latency recording.
+    timeout is a (connect, read) tuple in seconds, rate is requests per second (0 for no limit).
+    """
+
+    def __init__(self, timeout=(10, 300), retries=5, backoff=0.5, max_backoff=60, rate=0, pool_size=16):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.bucket = TokenBucket(rate)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept': 'application/fhir+json'})
+        self.latency = {}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, method, url):
+        # Group requests by operation, e.g. GET /fhir/ValueSet/$expand
+        return "{0} {1}".format(method, urlparse(url).path)
+
+    def _record(self, endpoint, elapsed):
+        with self._lock:
+            self.latency.setdefault(endpoint, []).append(elapsed)
+
+    ## merge_latency
+    ## Add request latencies recorded elsewhere, e.g. by a worker process, {endpoint: [seconds, ...]}
+    def merge_latency(self, latency):
+        with self._lock:
+            for endpoint, times in latency.items():
+                self.latency.setdefault(endpoint, []).extend(times)
+
+    def _retry_wait(self, attempt, response):
+        if response is not None and 'Retry-After' in response.headers:
+            value = response.headers['Retry-After']
+            try:
+                return min(float(value), self.max_backoff)
+            except ValueError:
+                try:
+                    return min(max(parsedate_to_datetime(value).timestamp() - time.time(), 0), self.max_backoff)
+                except (TypeError, ValueError):
+                    pass
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request, retrying connection errors, timeouts and 429/5xx responses.
+        The last response is returned once the retries are used up, the last connection
+        error is raised.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = self._endpoint(method, url)
+        # A file body is streamed, rewind it before each retry
+        body = kwargs.get('data')
+        position = body.tell() if hasattr(body, 'seek') else None
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            if position is not None:
+                body.seek(position)
+            start = time.perf_counter()
+            response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(endpoint, time.perf_counter() - start)
+                if attempt >= self.retries:
+                    raise
+                logger.warning(f'{endpoint} failed ({e}), retry {attempt + 1} of {self.retries}')
+            else:
+                self._record(endpoint, time.perf_counter() - start)
+                if response.status_code not in RETRY_STATUS or attempt >= self.retries:
+                    return response
+                logger.warning(f'{endpoint} returned {response.status_code}, retry {attempt + 1} of {self.retries}')
+            time.sleep(self._retry_wait(attempt, response))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def stats(self):
+        """
+        Request count, latency summary and percentiles (seconds) and a latency histogram per endpoint.
+        The histogram counts requests taking up to each bucket's upper bound, "+Inf" for the rest.
+        """
+        with self._lock:
+            latency = {k: sorted(v) for k, v in self.latency.items()}
+        stats = {}
+        for endpoint, times in latency.items():
+            histogram = {}
+            i = 0
+            for bound in LATENCY_BUCKETS:
+                n = bisect_right(times, bound)
+                histogram[str(bound)] = n - i
+                i = n
+            histogram["+Inf"] = len(times) - i
+            stats[endpoint] = {
+                "count": len(times),
+                "total": round(sum(times), 3),
+                "mean": round(sum(times) / len(times), 4),
+                "p50": round(percentile(times, 50), 4),
+                "p95": round(percentile(times, 95), 4),
+                "p99": round(percentile(times, 99), 4),
+                "max": round(times[-1], 4),
+                "histogram": histogram
+            }
+        return stats
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+## get_client
+##   return the shared TerminologyClient, creating it with the default settings on first use
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = TerminologyClient()
+        return _client
+
+
+## configure
+##   replace the shared TerminologyClient with one using these settings
+def configure(**kwargs):
+    global _client
+    with _client_lock:
+        _client = TerminologyClient(**kwargs)
+        return _client
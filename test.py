@@ -1,10 +1,27 @@
+import gzip
+import hashlib
 import json
 import unittest
 import fetcher
 import lighter
 import helpers
+import journal
+import metrics
 import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from cache import TerminologyCache
+from conceptset import ConceptSet
+from termclient import TerminologyClient
+from rf2 import Rf2Snapshot
+import stubserver
 from fhirclient.models import valueset as vs
+from fhirclient.models import conceptmap
 from fhirpathpy import evaluate
 
 endpoint = 'https://r4.ontoserver.csiro.au/fhir'
@@ -53,6 +70,621 @@ class TestFetcher(unittest.TestCase):
             if row["TypeId"] == 1:
                 self.assertIn('50408007',row["TargetValue"])
 
+class TestCache(unittest.TestCase):
+    def test_cache_hit_miss_and_version(self):
+        """
+        Check that responses are cached per SNOMED version and counted
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cachefile = os.path.join(tmpdir,'terminology.sqlite')
+            url = endpoint + '/ValueSet/$expand?url=ecl'
+            tc = TerminologyCache(cachefile,version='v1')
+            self.assertIsNone(tc.get(url))
+            tc.put(url,{"expansion":{"contains":[{"code":"7771000"}]}})
+            self.assertEqual(tc.get(url)["expansion"]["contains"][0]["code"],"7771000")
+            self.assertEqual(tc.stats()["hits"],1)
+            self.assertEqual(tc.stats()["misses"],1)
+            tc.close()
+            # A new SNOMED CT version must not see the old entries
+            tc = TerminologyCache(cachefile,version='v2')
+            self.assertIsNone(tc.get(url))
+            tc.close()
+
+    def test_cache_ttl_and_eviction(self):
+        """
+        Check that expired entries are ignored and the cache stays under its size limit
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cachefile = os.path.join(tmpdir,'terminology.sqlite')
+            tc = TerminologyCache(cachefile,ttl=0.000001)
+            tc.put('a',{"n":1})
+            self.assertIsNone(tc.get('a'))
+            tc.close()
+            tc = TerminologyCache(cachefile,max_bytes=200)
+            for i in range(20):
+                tc.put(str(i),{"n":os.urandom(16).hex()})
+            self.assertGreater(tc.stats()["evictions"],0)
+            self.assertIsNotNone(tc.get('19'))
+            # the running total matches the table, and a recent hit is the last to be evicted
+            self.assertEqual(tc.total_bytes,tc._size())
+            self.assertLessEqual(tc.total_bytes,200)
+            tc.put('19',{"n":"replaced"})
+            tc.get('19')
+            tc.put('20',{"n":os.urandom(16).hex()})
+            tc.put('21',{"n":os.urandom(16).hex()})
+            self.assertEqual(tc.total_bytes,tc._size())
+            self.assertIsNotNone(tc.get('19'))
+            tc.close()
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """
+    Returns 503 with Retry-After for the first two requests, then 200
+    """
+    calls = 0
+    def do_GET(self):
+        FlakyHandler.calls += 1
+        if FlakyHandler.calls <= 2:
+            self.send_response(503)
+            self.send_header('Retry-After','0')
+            self.end_headers()
+        else:
+            body = b'{"status":"active"}'
+            self.send_response(200)
+            self.send_header('Content-Type','application/fhir+json')
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    def log_message(self, format, *args):
+        pass
+
+class TestTermClient(unittest.TestCase):
+    def test_retry_after_and_latency(self):
+        """
+        Check that 503 responses are retried and every attempt is timed
+        """
+        server = HTTPServer(('127.0.0.1',0),FlakyHandler)
+        thread = threading.Thread(target=server.serve_forever,daemon=True)
+        thread.start()
+        try:
+            tc = TerminologyClient(retries=3,rate=100)
+            response = tc.get('http://127.0.0.1:{0}/fhir/metadata'.format(server.server_port))
+            self.assertEqual(response.status_code,200)
+            self.assertEqual(response.json()["status"],"active")
+            self.assertEqual(tc.stats()["GET /fhir/metadata"]["count"],3)
+        finally:
+            server.shutdown()
+
+class TestMetrics(unittest.TestCase):
+    def test_stages_latency_and_profile(self):
+        run = metrics.reset()
+        for i in range(3):
+            with metrics.stage("work"):
+                sum(range(10000))
+        run.count("rows",5)
+        client = TerminologyClient()
+        for i in range(1,101):
+            client._record("GET /fhir/ValueSet/$expand",i/1000)
+        stats = client.stats()["GET /fhir/ValueSet/$expand"]
+        self.assertEqual((stats["p50"],stats["p95"],stats["p99"]),(0.05,0.095,0.099))
+        self.assertEqual(sum(stats["histogram"].values()),100)
+        snapshot = run.snapshot()
+        self.assertEqual(snapshot["stages"]["work"]["count"],3)
+        self.assertEqual(snapshot["counters"]["rows"],5)
+        with metrics.Profiler(interval=0.001) as profiler:
+            end = time.perf_counter() + 0.2
+            while time.perf_counter() < end:
+                pass
+        self.assertTrue(any("test_stages_latency_and_profile" in stack for stack in profiler.samples))
+
+
+class TestStartup(unittest.TestCase):
+    def loaded(self, code):
+        heavy = ['fetcher','pandas','numpy','fhirpathpy','antlr4']
+        script = f'import sys; {code}; print(",".join(m for m in {heavy!r} if m in sys.modules))'
+        result = subprocess.run([sys.executable,'-c',script],capture_output=True,text=True,check=True)
+        return result.stdout.strip()
+
+    def test_lazy_imports(self):
+        # --help and a --skip lighter-only rebuild load none of fetcher's dependencies
+        self.assertEqual(self.loaded('import main'),'')
+        self.assertEqual(self.loaded('import lighter'),'')
+        self.assertIn('fetcher',self.loaded('import fetcher'))
+        # the FHIRPath engine is only loaded when an expression is evaluated
+        self.assertNotIn('fhirpathpy',self.loaded('import fetcher'))
+
+
+class TestConceptSet(unittest.TestCase):
+    def test_membership(self):
+        left = ConceptSet(["787058006","999002006","82169009","787058006"])
+        right = ConceptSet([999001004,"999003001"])
+        self.assertEqual(len(left),3)
+        self.assertIn("787058006",left)
+        self.assertIn(82169009,left)
+        self.assertNotIn("999001004",left)
+        self.assertNotIn("not a code",left)
+        self.assertEqual(list(left | right),["82169009","787058006","999001004","999002006","999003001"])
+        mask = left.contains_many(["999002006","999001004","","82169009"])
+        self.assertEqual(mask.tolist(),[True,False,False,True])
+        self.assertEqual(ConceptSet().contains_many(["82169009"]).tolist(),[False])
+
+
+class TestReader(unittest.TestCase):
+    def test_read_s2s_chunks(self):
+        """
+        Check that equivalent target codes are deduplicated in file order across chunks
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            s2sfile = os.path.join(tmpdir,'s2s.tsv')
+            with open(s2sfile,'w') as fh:
+                fh.write("Source code\tTarget code\tRelationship type code\tStatus\n")
+                for source, target, rel in [("A","3","TARGET_EQUIVALENT"),("B","1","TARGET_EQUIVALENT"),
+                                            ("C","2","TARGET_NARROWER"),("D","3","TARGET_EQUIVALENT"),
+                                            ("E","","TARGET_EQUIVALENT"),("F","2","TARGET_EQUIVALENT"),
+                                            ("G","1","TARGET_EQUIVALENT")]:
+                    fh.write(f"{source}\t{target}\t{rel}\tACCEPTED\n")
+            digest = hashlib.sha256()
+            codes = list(fetcher.read_s2s(s2sfile,digest,chunksize=2))
+            whole = hashlib.sha256()
+            list(fetcher.read_s2s(s2sfile,whole))
+        self.assertEqual(codes,["3","1","2"])
+        # the export's digest doesn't depend on the chunking
+        self.assertEqual(digest.hexdigest(),whole.hexdigest())
+        self.assertEqual(digest.hexdigest(),hashlib.sha256(b"A\t3\tTARGET_EQUIVALENT\nB\t1\tTARGET_EQUIVALENT\nC\t2\tTARGET_NARROWER\n"
+                         b"D\t3\tTARGET_EQUIVALENT\nE\t\tTARGET_EQUIVALENT\nF\t2\tTARGET_EQUIVALENT\nG\t1\tTARGET_EQUIVALENT\n").hexdigest())
+
+class TestRrsTable(unittest.TestCase):
+    def test_load_rrs_once(self):
+        table = lighter.load_rrs(os.path.join('.','test_data','rrs.txt'))
+        self.assertGreater(len(table),0)
+        self.assertEqual(table.rows[0]._fields,('Service','Procedure','Site','Laterality','Contrast'))
+        # every column's unique values, in order of first appearance
+        for col in range(0,5):
+            values = [row[col] for row in table]
+            self.assertEqual(list(table.columns[col]),list(dict.fromkeys(values)))
+        with self.assertRaises(AttributeError):
+            table.rows = ()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            template = os.path.join('.','templates','ValueSet-radiology-procedure-template.json')
+            outfile = os.path.join(tmpdir,'procedure.json')
+            self.assertEqual(lighter.build_valueset(1,template,table,outfile,None),200)
+            with open(outfile) as fh:
+                codes = [c["code"] for c in json.load(fh)["compose"]["include"][0]["concept"]]
+        self.assertEqual(codes,[c for c in table.columns[1] if c.isdigit()])
+
+
+    def test_concept_map_fast_path(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            lighter.build_concept_map(os.path.join('.','test_data','rrs.txt'),tmpdir,None,'templates')
+            mapfile = os.path.join(tmpdir,"ConceptMap_RadiologyServices.json")
+            with open(mapfile) as fh:
+                text = fh.read()
+            lighter.build_concept_map(os.path.join('.','test_data','rrs.txt'),tmpdir,None,'templates',compact=True)
+            with open(mapfile) as fh:
+                compact = fh.read()
+        # the same bytes the fhirclient model and json.dump produce
+        data = json.loads(text)
+        self.assertEqual(text,json.dumps(conceptmap.ConceptMap(data).as_json(),indent=2))
+        self.assertNotIn("\n",compact)
+        self.assertEqual(json.loads(compact),data)
+
+
+class TestRf2(unittest.TestCase):
+    """
+    Run the fetcher queries against the RF2 fixture in test_data/rf2
+    """
+    @classmethod
+    def setUpClass(cls):
+        fetcher.set_terminology('local:'+os.path.join('.','test_data','rf2'))
+
+    @classmethod
+    def tearDownClass(cls):
+        fetcher.local = None
+
+    def test_fhirpath_extractors(self):
+        # the dict walkers return exactly what the FHIRPath expressions do
+        for code in ["999004007","999009002","999011006","169070004","12345678"]:
+            data = fetcher.local.lookup(code)
+            expected = evaluate(data,fetcher.fhirpaths["subproperty_parts"])
+            self.assertEqual(fetcher.subproperty_parts(data),expected)
+            self.assertEqual(fetcher.fhirpath("subproperty_parts",data),expected)
+        for ecl in ["<<71388002","<123037004:272741003=7771000","<999999999"]:
+            data = fetcher.get_valueset("http://snomed.info/sct?fhir_vs=ecl/"+ecl)
+            self.assertEqual(fetcher.expansion_codes(data),evaluate(data,"expansion.contains.code"))
+
+    def test_local_body_structures(self):
+        data = fetcher.get_body_structures("left")
+        self.assertIn("787058006",data)
+        self.assertNotIn("225403000",data)
+        self.assertNotIn("6757004",data)
+
+    def test_local_ecl_refinements_and_filters(self):
+        self.assertIn("425703002",fetcher.get_bilateral_procedures())
+        self.assertNotIn("426420006",fetcher.get_bilateral_procedures())
+        self.assertIn("1187246003",fetcher.get_procedures_without_contrast())
+        self.assertNotIn("169070004",fetcher.get_procedures_without_contrast())
+        self.assertEqual(fetcher.split_site("82169009"),["72696002"])
+
+    def test_local_snomed_properties(self):
+        rrs_df = fetcher.get_snomed_props("765041007")
+        sites = rrs_df[rrs_df["TypeId"] == 1]["TargetValue"].tolist()
+        self.assertEqual(sites,["50408007"])
+
+    def test_local_paging(self):
+        snapshot = Rf2Snapshot(os.path.join('.','test_data','rf2'))
+        url = 'http://snomed.info/sct?fhir_vs=ecl/<<71388002'
+        everything = snapshot.expand(url)["expansion"]
+        page = snapshot.expand(url,offset=5,count=5)["expansion"]
+        self.assertEqual(page["total"],everything["total"])
+        self.assertEqual(page["contains"],everything["contains"][5:10])
+
+class TestStubServer(unittest.TestCase):
+    """
+    Run the fetcher and lighter pipelines end to end against the local stand-in server
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.server = stubserver.start_server()
+        cls.saved_baseurl = fetcher.baseurl
+        fetcher.set_terminology(cls.server.base_url)
+
+    @classmethod
+    def tearDownClass(cls):
+        fetcher.baseurl = cls.saved_baseurl
+        cls.server.shutdown()
+
+    def write_s2s(self,dirname,codes):
+        s2sfile = os.path.join(dirname,'s2s.tsv')
+        with open(s2sfile,'w') as fh:
+            fh.write("Source code\tSource display\tTarget code\tTarget display\tRelationship type code\n")
+            for n, code in enumerate(codes):
+                fh.write(f"RAD{n}\tsource\t{code}\ttarget\tTARGET_EQUIVALENT\n")
+        return s2sfile
+
+    def test_server_is_up(self):
+        self.assertTrue(fetcher.check_terminology_server())
+
+    def test_paged_expansion(self):
+        url = 'http://snomed.info/sct?fhir_vs=ecl/<<71388002'
+        everything = fetcher.expansion_codes(fetcher.get_valueset(url))
+        requests = self.server.store.requests
+        codes = list(fetcher.iter_valueset_codes(url,page_size=4))
+        self.assertEqual(codes,everything)
+        self.assertEqual(self.server.store.requests - requests,-(-len(everything)//4))
+        self.assertEqual(list(fetcher.get_valueset_codes(url,page_size=4)),sorted(everything,key=int))
+        self.assertIn("787058006",fetcher.get_body_structures("left"))
+        # a page that fails part way through the expansion fails the whole set
+        store = self.server.store
+        expand = store.expand
+        store.expand = lambda query: (400,stubserver.operation_outcome("error","too-costly","no"),{}) \
+            if query.get('offset') == ['4'] else expand(query)
+        try:
+            with self.assertRaises(ValueError):
+                fetcher.get_valueset_codes(url,page_size=4)
+        finally:
+            del store.expand
+
+    def test_run_main_batch_and_workers(self):
+        """
+        Check that batching and workers don't change rrs.txt
+        """
+        codes = ["425703002","426420006","169070004","1187246003","765041007","999008005","999009002","426420006"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            s2sfile = self.write_s2s(tmpdir,codes)
+            run = metrics.reset()
+            with open(fetcher.run_main(s2sfile,tmpdir,batch_size=0)) as fh:
+                serial = fh.read()
+            # one read per chunk of codes and a last one finding the export's end
+            self.assertEqual(run.snapshot()["stages"]["fetcher.read"]["count"],2)
+            with open(fetcher.run_main(s2sfile,tmpdir,workers=4,batch_size=3)) as fh:
+                concurrent = fh.read()
+        self.assertEqual(serial,concurrent)
+        lines = serial.splitlines()
+        self.assertEqual(len(lines),8)
+        self.assertEqual(lines[1].split("\t"),["425703002","168537006","70258002","51440002",""])
+        self.assertEqual(lines[4].split("\t"),["1187246003","77477000","818981001","","373067005"])
+
+    def test_failed_batch_lookup(self):
+        """
+        Check that a batch POST that fails outright falls back to single lookups rather than ending the run
+        """
+        codes = ["425703002","426420006","169070004"]
+        client = fetcher.get_client()
+        def reset(*args,**kwargs):
+            raise requests.ConnectionError("reset")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            s2sfile = self.write_s2s(tmpdir,codes)
+            with open(fetcher.run_main(s2sfile,tmpdir,batch_size=0)) as fh:
+                serial = fh.read()
+            client.post = reset
+            try:
+                with open(fetcher.run_main(s2sfile,tmpdir,batch_size=2)) as fh:
+                    fallback = fh.read()
+            finally:
+                del client.post
+        self.assertEqual(fallback,serial)
+
+    def fail_lookups(self,code):
+        """
+        Make the stand-in server answer every lookup of code with 503, until restore_lookups()
+        """
+        store = self.server.store
+        lookup = store.lookup
+        def flaky(query):
+            if query.get('code',[''])[0] == code:
+                return 503, stubserver.operation_outcome("error","transient","unavailable"), {"Retry-After": "0"}
+            return lookup(query)
+        store.lookup = flaky
+
+    def restore_lookups(self):
+        del self.server.store.lookup
+
+    def test_failed_lookup_retried_on_resume(self):
+        """
+        Check that a code whose lookup keeps failing isn't journaled, so a resumed build retries it
+        """
+        codes = ["425703002","426420006","169070004"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            s2sfile = self.write_s2s(tmpdir,codes)
+            with open(fetcher.run_main(s2sfile,tmpdir)) as fh:
+                full = fh.read()
+            self.fail_lookups("426420006")
+            try:
+                fetcher.run_main(s2sfile,tmpdir)
+            finally:
+                self.restore_lookups()
+            with open(os.path.join(tmpdir,'rrs.journal')) as fh:
+                self.assertEqual([json.loads(line)["code"] for line in fh],["425703002","169070004"])
+            with open(fetcher.run_main(s2sfile,tmpdir,resume=True)) as fh:
+                resumed = fh.read()
+        self.assertEqual(resumed,full)
+
+    def test_delta_after_failed_lookup(self):
+        """
+        Check that a code whose lookup failed isn't carried over by the next delta build
+        """
+        codes = ["425703002","426420006","169070004"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            s2sfile = self.write_s2s(tmpdir,codes)
+            self.fail_lookups("426420006")
+            try:
+                fetcher.run_main(s2sfile,tmpdir)
+            finally:
+                self.restore_lookups()
+            with open(os.path.join(tmpdir,'rrs.manifest.json')) as fh:
+                self.assertNotIn("426420006",json.load(fh)["rows"])
+            fetched = []
+            saved = fetcher.get_concept_props_batch
+            fetcher.get_concept_props_batch = lambda codes,chunk_size=100: fetched.extend(codes) or saved(codes,chunk_size)
+            try:
+                with open(fetcher.run_main(s2sfile,tmpdir,delta=True)) as fh:
+                    delta = fh.read()
+            finally:
+                fetcher.get_concept_props_batch = saved
+            with open(fetcher.run_main(s2sfile,tmpdir)) as fh:
+                full = fh.read()
+        self.assertEqual(fetched,["426420006"])
+        self.assertEqual(delta,full)
+
+    def test_resume_from_journal(self):
+        """
+        Check that a resumed build only fetches the codes missing from the journal
+        """
+        codes = ["425703002","426420006","169070004","1187246003","765041007"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            s2sfile = self.write_s2s(tmpdir,codes)
+            with open(fetcher.run_main(s2sfile,tmpdir,batch_size=0)) as fh:
+                full = fh.read()
+            journalfile = os.path.join(tmpdir,'rrs.journal')
+            with open(journalfile) as fh:
+                entries = fh.readlines()
+            # Interrupted after two rows, part way through writing the third
+            with open(journalfile,'w') as fh:
+                fh.writelines(entries[:2])
+                fh.write(entries[2][:10])
+            with open(os.path.join(tmpdir,'rrs.txt'),'w') as fh:
+                fh.write('')
+            fetched = []
+            saved = fetcher.get_snomed_props
+            fetcher.get_snomed_props = lambda code,data=None: fetched.append(code) or saved(code,data)
+            try:
+                with open(fetcher.run_main(s2sfile,tmpdir,batch_size=0,resume=True)) as fh:
+                    resumed = fh.read()
+            finally:
+                fetcher.get_snomed_props = saved
+            # the torn entry was cut off rather than appended to
+            with open(journalfile) as fh:
+                self.assertEqual([json.loads(line)["code"] for line in fh],codes)
+        self.assertEqual(resumed,full)
+        self.assertEqual(fetched,codes[2:])
+
+    def test_delta_build(self):
+        """
+        Check that a delta build only fetches new target codes and matches a full build
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fetcher.run_main(self.write_s2s(tmpdir,["425703002","426420006","169070004"]),tmpdir)
+            s2sfile = self.write_s2s(tmpdir,["425703002","1187246003","169070004","765041007"])
+            fetched = []
+            saved = fetcher.get_concept_props_batch
+            fetcher.get_concept_props_batch = lambda codes,chunk_size=100: fetched.extend(codes) or saved(codes,chunk_size)
+            try:
+                with open(fetcher.run_main(s2sfile,tmpdir,delta=True)) as fh:
+                    delta = fh.read()
+            finally:
+                fetcher.get_concept_props_batch = saved
+            with open(fetcher.run_main(s2sfile,tmpdir)) as fh:
+                full = fh.read()
+            # edited focus procedures change every row's Procedure, so nothing is carried over
+            saved_digest = fetcher.procedures_digest
+            fetcher.procedures_digest = lambda: "edited"
+            fetcher.get_concept_props_batch = lambda codes,chunk_size=100: fetched.extend(codes) or saved(codes,chunk_size)
+            try:
+                fetcher.run_main(s2sfile,tmpdir,delta=True)
+            finally:
+                fetcher.procedures_digest = saved_digest
+                fetcher.get_concept_props_batch = saved
+        self.assertEqual(delta,full)
+        self.assertEqual(fetched,["1187246003","765041007","425703002","1187246003","169070004","765041007"])
+
+    def test_sharded_build(self):
+        """
+        Check that merged shards, built here or in worker processes, match a serial build
+        """
+        codes = ["425703002","426420006","169070004","1187246003","765041007","999008005","426420006"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            s2sfile = self.write_s2s(tmpdir,codes)
+            with open(fetcher.run_main(s2sfile,tmpdir)) as fh:
+                serial = fh.read()
+            os.remove(os.path.join(tmpdir,'rrs.txt'))
+            with self.assertRaises(FileNotFoundError):
+                fetcher.merge_shards(s2sfile,tmpdir,2)
+            parts = [fetcher.run_main(s2sfile,tmpdir,shard=(i,2)) for i in range(2)]
+            self.assertEqual([os.path.basename(p) for p in parts],['rrs.part-0-of-2.txt','rrs.part-1-of-2.txt'])
+            with open(fetcher.merge_shards(s2sfile,tmpdir,2)) as fh:
+                merged = fh.read()
+            run = metrics.reset()
+            logfile = os.path.join(tmpdir,'build.log')
+            with open(fetcher.run_sharded(s2sfile,tmpdir,2,self.server.base_url,None,dict(filename=logfile,level="INFO"),
+                                          cachefile=os.path.join(tmpdir,'cache.sqlite'))) as fh:
+                processes = fh.read()
+            with open(logfile) as fh:
+                log = fh.read()
+            # the workers log to the run's log file and their metrics are added to the run's
+            self.assertIn('rrs.part-1-of-2.txt',log)
+            snapshot = run.snapshot()
+            self.assertEqual(snapshot["stages"]["get_snomed_props"]["count"],6)
+            self.assertEqual(snapshot["gauges"]["shard1.fetcher.codes"],6)
+            self.assertTrue(any(endpoint.endswith('/$expand') for endpoint in snapshot["http"]))
+        self.assertEqual(merged,serial)
+        self.assertEqual(processes,serial)
+        # a shard index outside the shard count is refused
+        result = subprocess.run([sys.executable,'main.py','--shard','2/2'],capture_output=True,text=True)
+        self.assertEqual(result.returncode,2)
+        self.assertIn('shard index',result.stderr)
+
+    def test_publish_and_validate(self):
+        smart = lighter.create_client(self.server.base_url)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = os.path.join(tmpdir,'service.json')
+            template = os.path.join('.','templates','ValueSet-radiology-services-template.json')
+            run = metrics.reset()
+            status = lighter.build_valueset(0,template,os.path.join('.','test_data','rrs.txt'),outfile,smart)
+            self.assertEqual(status,201)
+            self.assertEqual(run.snapshot()["stages"]["lighter.publish"]["count"],1)
+            with open(outfile) as fh:
+                data = json.load(fh)
+        self.assertEqual(helpers.validate_resource(data,"ValueSet",self.server.base_url),200)
+        self.assertIn(("ValueSet",data["id"]),self.server.store.resources)
+
+    def test_publish_streamed_concept_map(self):
+        smart = lighter.create_client(self.server.base_url)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            rrsfile = os.path.join('.','test_data','rrs.txt')
+            self.assertEqual(lighter.build_concept_map(rrsfile,tmpdir,smart,'templates'),201)
+            with open(os.path.join(tmpdir,"ConceptMap_RadiologyServices.json")) as fh:
+                data = json.load(fh)
+        table = lighter.load_rrs(rrsfile)
+        self.assertEqual(len(data["group"][0]["element"]),sum(1 for row in table if row.Service))
+        stored = self.server.store.resources[("ConceptMap",data["id"])]
+        self.assertEqual(stored["group"],data["group"])
+
+
+    def test_publish_transaction(self):
+        smart = lighter.create_client(self.server.base_url)
+        table = lighter.load_rrs(os.path.join('.','test_data','rrs.txt'))
+        templates = lighter.get_template_files('templates')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = lighter.create_vs_filepath(tmpdir)
+            manifest = journal.ArtefactManifest(os.path.join(tmpdir,'artefacts.manifest.json'))
+            for col in range(0,5):
+                lighter.build_valueset(col,templates[col],table,files[col],None,manifest=manifest)
+            lighter.build_concept_map(table,tmpdir,None,'templates',manifest=manifest)
+            files.append(os.path.join(tmpdir,"ConceptMap_RadiologyServices.json"))
+            requests = self.server.store.requests
+            self.assertEqual(lighter.publish_transaction(smart,files,tmpdir,manifest),201)
+            # one round trip carrying every artefact, each entry's resource copied from its file
+            self.assertEqual(self.server.store.requests - requests,1)
+            with gzip.open(os.path.join(tmpdir,'Bundle-publish.json.gz')) as fh:
+                bundle = json.load(fh)
+            for filename, entry in zip(files,bundle["entry"]):
+                with open(filename) as fh:
+                    self.assertEqual(entry["resource"],json.load(fh))
+            # without the manifest each file is read for its url, and a second publish updates them in place
+            self.assertEqual(lighter.publish_transaction(smart,files,tmpdir),201)
+            canonicals = []
+            for filename in files:
+                with open(filename) as fh:
+                    data = json.load(fh)
+                canonicals.append((data["resourceType"],data["url"]))
+        stored = [(t,r["url"]) for (t,i),r in self.server.store.resources.items() if (t,r.get("url")) in canonicals]
+        self.assertEqual(sorted(stored),sorted(canonicals))
+        # a failing entry rolls back the whole transaction
+        saved = dict(self.server.store.resources)
+        status, outcome, headers = self.server.store.handle('POST','',{},{"resourceType":"Bundle","type":"transaction","entry":[
+            {"resource":{"resourceType":"ValueSet","url":"http://example.org/new"},"request":{"method":"PUT","url":"ValueSet?url=http://example.org/new"}},
+            {"resource":{"resourceType":"ConceptMap"},"request":{"method":"PUT","url":"ValueSet?url=http://example.org/bad"}}]})
+        self.assertEqual(status,400)
+        self.assertEqual(self.server.store.resources,saved)
+
+
+    def test_skip_unchanged_artefacts(self):
+        smart = lighter.create_client(self.server.base_url)
+        table = lighter.load_rrs(os.path.join('.','test_data','rrs.txt'))
+        template = lighter.get_template_files('templates')[1]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = os.path.join(tmpdir,'procedure.json')
+            manifestfile = os.path.join(tmpdir,'artefacts.manifest.json')
+            manifest = journal.ArtefactManifest(manifestfile)
+            self.assertEqual(lighter.build_valueset(1,template,table,outfile,smart,manifest=manifest),201)
+            manifest.save()
+            mtime = os.stat(outfile).st_mtime_ns
+            requests = self.server.store.requests
+            # nothing changed: the file isn't rewritten and nothing is sent to the server
+            manifest = journal.ArtefactManifest(manifestfile)
+            self.assertEqual(lighter.build_valueset(1,template,table,outfile,smart,manifest=manifest),200)
+            self.assertEqual(os.stat(outfile).st_mtime_ns,mtime)
+            self.assertEqual(self.server.store.requests,requests)
+            # the server copy is checked with If-None-Match, and republished once it has been changed there
+            manifest = journal.ArtefactManifest(manifestfile,check_server=True)
+            self.assertEqual(lighter.build_valueset(1,template,table,outfile,smart,manifest=manifest),200)
+            with open(outfile) as fh:
+                data = json.load(fh)
+            self.server.store.write("ValueSet",data["id"],dict(data,status="retired"))
+            self.assertEqual(lighter.build_valueset(1,template,table,outfile,smart,manifest=manifest),201)
+            self.assertEqual(self.server.store.resources[("ValueSet",data["id"])]["status"],data["status"])
+
+
+    def test_validate_artefacts(self):
+        self.assertTrue(helpers.is_sctid("168537006"))
+        self.assertFalse(helpers.is_sctid("168537007"))
+        self.assertFalse(helpers.is_sctid("0168537006"))
+        table = lighter.load_rrs(os.path.join('.','test_data','rrs.txt'))
+        templates = lighter.get_template_files('templates')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = lighter.create_vs_filepath(tmpdir)
+            for col in range(0,5):
+                lighter.build_valueset(col,templates[col],table,files[col],None)
+            lighter.build_concept_map(table,tmpdir,None,'templates')
+            files.append(os.path.join(tmpdir,"ConceptMap_RadiologyServices.json"))
+            with open(files[0]) as fh:
+                data = json.load(fh)
+            data["compose"]["include"][0]["concept"].append({"code": "12345678"})
+            del data["status"]
+            broken = os.path.join(tmpdir,'broken.json')
+            with open(broken,'w') as fh:
+                json.dump(data,fh)
+            requests = self.server.store.requests
+            results = helpers.validate_files(files + [broken],self.server.base_url)
+        # the broken ValueSet fails the local checks without being sent to the server
+        self.assertEqual(self.server.store.requests - requests,len(files))
+        self.assertTrue(all(results[f][0] for f in files))
+        valid, issues = results[broken]
+        self.assertFalse(valid)
+        self.assertEqual(sorted(i["code"] for i in issues),["code-invalid","required"])
+        # rrs.txt has one repeated row, reported but not an error
+        self.assertEqual([i["code"] for i in results[files[5]][1] if i["severity"] == "warning"],["duplicate"])
+
+
 class TestLighter(unittest.TestCase):  
         
     def test_build_valueset(self):